@@ -1,30 +1,101 @@
 #!/usr/bin/env python3
 import argparse
 import json
+import os
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from uuid import uuid4
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 from tqdm import tqdm  # pip install tqdm
 
-def extract_audio_segment(video_path: Path, out_dir: Path, segment_idx: int, sr=16000, start_time=None, duration=None, threads=2):
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+try:
+    import webrtcvad  # 可选：pip install webrtcvad，缺失时不做静音跳过
+except Exception:
+    webrtcvad = None
+
+def _dumps_line(rec):
+    if orjson is not None:
+        return orjson.dumps(rec) + b"\n"
+    return (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+
+# 绝对路径只解析一次；配合 close_fds=False（Python 打开的 fd 默认不可继承），
+# subprocess 可走 posix_spawn 快路径，省掉大进程 fork 时的页表复制
+FFMPEG = shutil.which("ffmpeg") or "ffmpeg"
+PIPE_READ_SIZE = 1 << 20
+# 解码结果超过该大小（16k float32 约 17 分钟）就转存到 tmp_audio_dir 再内存映射，
+# 长视频的音频由页缓存承载、可被换出，预解码 + 转写中的多个视频不会把整段音频都压在常驻内存里
+SPILL_BYTES = 64 << 20
+
+def extract_audio(video_path: Path, sr=16000, threads=2, spill_dir=None):
     """
-    提取视频或音频的一段，返回生成的 wav 文件路径
+    ffmpeg 一次解码整个视频，直接输出 float32 PCM 经管道读入，返回单声道数组；
+    短音频留在内存里，超过 SPILL_BYTES 且给了 spill_dir 时写入临时文件并以只读 memmap 返回
     """
-    out_dir.mkdir(parents=True, exist_ok=True)
-    wav_name = f"{video_path.stem}_seg{segment_idx:03d}.wav"
-    wav_path = out_dir / wav_name
+    cmd = [FFMPEG, "-nostdin", "-threads", str(threads), "-i", str(video_path),
+           "-vn", "-ac", "1", "-ar", str(sr), "-f", "f32le", "pipe:1"]
 
-    cmd = ["ffmpeg", "-y", "-threads", str(threads), "-i", str(video_path)]
-    if start_time is not None and duration is not None:
-        cmd += ["-ss", str(start_time), "-t", str(duration)]
-    cmd += ["-vn", "-ac", "1", "-ar", str(sr), "-f", "wav", str(wav_path)]
+    # 读入可写的 bytearray 后零拷贝包装成数组，省掉 int16 -> float32 的转换和中间副本
+    buf = bytearray()
+    spill = None
+    try:
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, close_fds=False) as proc:
+            while chunk := proc.stdout.read(PIPE_READ_SIZE):
+                if spill is not None:
+                    spill.write(chunk)
+                    continue
+                buf += chunk
+                if spill_dir is not None and len(buf) > SPILL_BYTES:
+                    Path(spill_dir).mkdir(parents=True, exist_ok=True)
+                    spill = tempfile.NamedTemporaryFile(dir=spill_dir, suffix=".f32", delete=False)
+                    spill.write(buf)
+                    buf = bytearray()
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        if spill is None:
+            return np.frombuffer(buf, dtype=np.float32)
+        spill.close()
+        n = os.path.getsize(spill.name) // 4
+        return np.memmap(spill.name, dtype=np.float32, mode="r", shape=(n,))
+    finally:
+        if spill is not None:
+            spill.close()
+            # 映射建立后即可删除文件名（POSIX 下数据在映射释放前仍有效）；删不掉时留给调用方清理目录
+            try:
+                os.unlink(spill.name)
+            except OSError:
+                pass
 
-    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    return wav_path
+def resolve_compute_type(device: str, compute_type: str):
+    """
+    CTranslate2 混合精度：int8_float16 为 int8 权重 + fp16 激活，GPU 上走 int8 GEMM，
+    吞吐约翻倍、显存减半；CPU 不支持 fp16 激活，改用纯 int8。
+    auto 按硬件能力挑选：Ampere 及以上用 bfloat16（同样走 tensor core、不易溢出），
+    其次 int8_float16、float16；CPU 用 int8
+    """
+    if compute_type == "auto":
+        try:
+            import ctranslate2
+            supported = ctranslate2.get_supported_compute_types(device)
+        except Exception:
+            supported = set()
+        prefer = ("int8",) if device == "cpu" else ("bfloat16", "int8_float16", "float16")
+        return next((ct for ct in prefer if ct in supported), prefer[-1])
+    if device == "cpu" and compute_type.endswith("float16"):
+        return "int8"
+    return compute_type
 
-def load_engine(engine: str, model_size: str, device: str, compute_type: str):
+def load_engine(engine: str, model_size: str, device: str, compute_type: str, device_index=0, num_workers=1):
     if engine == "mslite":
         try:
             from mslite_whisper import LiteWhisperASR
@@ -34,8 +105,11 @@ def load_engine(engine: str, model_size: str, device: str, compute_type: str):
                 print("mslite engine not available", file=sys.stderr)
     if engine in ("faster-whisper", "auto"):
         try:
-            from faster_whisper import WhisperModel
-            return ("faster-whisper", WhisperModel(model_size, device=device, compute_type=compute_type))
+            from faster_whisper import WhisperModel, BatchedInferencePipeline
+            # device_index 传列表时一个模型分布在多张卡上，num_workers 个线程并发转写时轮流分配到各卡
+            model = WhisperModel(model_size, device=device, device_index=device_index, num_workers=num_workers,
+                                 compute_type=resolve_compute_type(device, compute_type))
+            return ("faster-whisper", BatchedInferencePipeline(model=model))
         except Exception:
             if engine == "faster-whisper":
                 print("faster-whisper not available", file=sys.stderr)
@@ -45,18 +119,47 @@ def load_engine(engine: str, model_size: str, device: str, compute_type: str):
     except Exception:
         raise RuntimeError("No ASR engine available. Install faster-whisper or openai-whisper.")
 
-def transcribe_faster(model, audio_path, language):
-    segments, info = model.transcribe(str(audio_path), language=language)
-    for i, seg in enumerate(segments):
-        yield {
-            "segment_id": f"{i:05d}",
+def _bucket_and_transcribe(model, audio, language, batch_size=16, chunk_length=30):
+    """
+    先用 VAD 切出不超过 chunk_length 秒的语音块，按时长排序后交给批量推理：
+    同一批内的块长度相近，解码步数对齐，少在短块上空等长块；结果再按时间顺序返回。
+    faster-whisper 1.2 起没有 merge_segments，clip_timestamps 也改成按秒、按时间顺序解析，
+    此时退回管线自带的 VAD 切块，不做时长排序
+    """
+    try:
+        from faster_whisper.vad import VadOptions, get_speech_timestamps, merge_segments
+    except ImportError:
+        segments, info = model.transcribe(audio, language=language, batch_size=batch_size, vad_filter=True)
+        return sorted(segments, key=lambda seg: seg.start)
+    vad_options = VadOptions(max_speech_duration_s=chunk_length, min_silence_duration_ms=160)
+    clips = merge_segments(get_speech_timestamps(audio, vad_options), vad_options)
+    if not clips:
+        return []
+    clips.sort(key=lambda c: c["end"] - c["start"])
+    segments, info = model.transcribe(audio, language=language, batch_size=batch_size, clip_timestamps=clips)
+    return sorted(segments, key=lambda seg: seg.start)
+
+def transcribe_faster(model, audio, language, segment_time, batch_size=16):
+    """
+    整个视频的音频只调用一次批量推理；按开始时间把每个识别片段归入 segment_time 分段，
+    返回 (分段序号, 片段)，时间为整段视频内的绝对毫秒
+    """
+    if audio.size == 0:
+        return
+    counts = {}
+    for seg in _bucket_and_transcribe(model, audio, language, batch_size):
+        idx = int(seg.start // segment_time)
+        n = counts.get(idx, 0)
+        counts[idx] = n + 1
+        yield idx, {
+            "segment_id": f"{n:05d}",
             "start_ms": int(seg.start * 1000),
             "end_ms": int(seg.end * 1000),
             "text": seg.text.strip()
         }
 
-def transcribe_whisper(model, audio_path, language):
-    result = model.transcribe(str(audio_path), language=language, verbose=False)
+def transcribe_whisper(model, audio, language):
+    result = model.transcribe(audio, language=language, verbose=False)
     for i, seg in enumerate(result.get("segments", [])):
         yield {
             "segment_id": f"{i:05d}",
@@ -65,8 +168,8 @@ def transcribe_whisper(model, audio_path, language):
             "text": str(seg.get("text", "")).strip()
         }
 
-def transcribe_mslite(model, audio_path, language):
-    for i, seg in enumerate(model.transcribe(str(audio_path), language=language)):
+def transcribe_mslite(model, audio, language):
+    for i, seg in enumerate(model.transcribe(audio, language=language)):
         yield {
             "segment_id": f"{i:05d}",
             "start_ms": int(seg.get("start_ms", 0)),
@@ -74,53 +177,113 @@ def transcribe_mslite(model, audio_path, language):
             "text": str(seg.get("text", "")).strip()
         }
 
-def get_video_duration(video_path: Path):
-    """获取视频时长，单位秒"""
-    cmd = ["ffprobe", "-v", "error", "-show_entries",
-           "format=duration", "-of",
-           "default=noprint_wrappers=1:nokey=1", str(video_path)]
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    return float(result.stdout.strip())
+VAD_FRAME_MS = 30
+VAD_MIN_VOICED = 0.05
+VAD_PAD_MS = 300
+
+def _speech_span(audio, sr=16000):
+    """
+    WebRTC VAD 按 30ms 帧判定人声：有声帧不足 5% 返回 None（整段跳过），
+    否则返回去掉首尾静音（两侧各留 300ms 余量）后的 (起, 止) 采样下标
+    """
+    if webrtcvad is None:
+        return 0, len(audio)
+    frame = sr * VAD_FRAME_MS // 1000
+    n = len(audio) // frame
+    if n == 0:
+        return None
+    pcm = (np.clip(audio[:n * frame], -1.0, 1.0) * 32767).astype("<i2").tobytes()
+    vad = webrtcvad.Vad(2)
+    step = frame * 2
+    voiced = [i for i in range(n) if vad.is_speech(pcm[i * step:(i + 1) * step], sr)]
+    if len(voiced) < VAD_MIN_VOICED * n:
+        return None
+    pad = sr * VAD_PAD_MS // 1000
+    return max(voiced[0] * frame - pad, 0), min((voiced[-1] + 1) * frame + pad, len(audio))
+
+def transcribe_each(eng_name, model, audio, language, segment_time, sr=16000, desc=None):
+    """按 segment_time 切片逐段转写（whisper / mslite），时间加上分段偏移后返回 (分段序号, 片段)"""
+    transcribe = transcribe_mslite if eng_name == "mslite" else transcribe_whisper
+    step = int(segment_time * sr)
+    for idx in tqdm(range(-(-len(audio) // step)), desc=desc, unit="seg", leave=False):
+        chunk = audio[idx * step:(idx + 1) * step]
+        # 基本静音的分段不送 ASR；有声的裁掉首尾静音，缩短编码器输入
+        span = _speech_span(chunk, sr)
+        if span is None:
+            continue
+        start, end = span
+        offset = idx * segment_time * 1000 + start * 1000 // sr
+        for seg in transcribe(model, chunk[start:end], language):
+            seg["start_ms"] += offset
+            seg["end_ms"] += offset
+            yield idx, seg
 
-def build_dataset(videos, out_jsonl, tmp_audio_dir, engine, model_size, device, compute_type, language, segment_time, max_workers=4, ffmpeg_threads=2):
-    eng_name, eng_obj = load_engine(engine, model_size, device, compute_type)
+_EXECUTORS = {}
+_EXECUTORS_LOCK = threading.Lock()
+
+def _get_executor(max_workers, name="ffmpeg"):
+    """线程池按 (用途, 线程数) 进程内复用，多次调用 build_dataset（如 GPU 失败后回退 CPU）不重复建线程"""
+    with _EXECUTORS_LOCK:
+        ex = _EXECUTORS.get((name, max_workers))
+        if ex is None:
+            ex = _EXECUTORS[(name, max_workers)] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        return ex
+
+def build_dataset(videos, out_jsonl, tmp_audio_dir, engine, model_size, device, compute_type, language, segment_time, max_workers=2, ffmpeg_threads=2, batch_size=16,
+                  device_index=0, num_workers=1):
+    eng_name, eng_obj = load_engine(engine, model_size, device, compute_type, device_index, num_workers)
+    vps = [Path(v) for v in videos if Path(v).exists()]
+    # 只有 faster-whisper 的模型支持多线程并发转写，其余引擎逐个视频串行
+    if eng_name != "faster-whisper":
+        num_workers = 1
+
+    # 流水线：ffmpeg 解码在线程池里提前跑（最多领先 max_workers 个视频；长音频转存到 tmp_audio_dir 内存映射）；
+    # ASR 线程池同时转写 num_workers 个视频（多卡时各占一张卡），当前线程按视频顺序写盘
+    executor = _get_executor(max_workers)
+    asr_executor = _get_executor(num_workers, "asr")
+
+    def submit_decode(i):
+        return executor.submit(extract_audio, vps[i], 16000, ffmpeg_threads, tmp_audio_dir)
+
+    def transcribe_video(vp, audio):
+        video_id = vp.stem
+        if eng_name == "faster-whisper":
+            gen = transcribe_faster(eng_obj, audio, language, segment_time, batch_size)
+        else:
+            gen = transcribe_each(eng_name, eng_obj, audio, language, segment_time, desc=f"Transcribing {video_id}")
+        buf = bytearray()
+        for idx, seg in gen:
+            rec = {
+                "id": str(uuid4()),
+                "video_id": video_id,
+                "segment_id": f"{idx}_{seg['segment_id']}",
+                "start_ms": seg["start_ms"],
+                "end_ms": seg["end_ms"],
+                "src": seg["text"]
+            }
+            buf += _dumps_line(rec)
+        return buf
 
     Path(out_jsonl).parent.mkdir(parents=True, exist_ok=True)
-    with open(out_jsonl, "w", encoding="utf-8") as f:
-        for v in tqdm(videos, desc="Videos", unit="video"):
-            vp = Path(v)
-            if not vp.exists():
-                continue
-            video_id = vp.stem
-            duration = get_video_duration(vp)
-            num_segments = int(duration // segment_time) + 1
-
-            # 并行处理每个片段
-            futures = {}
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                for idx in range(num_segments):
-                    start = idx * segment_time
-                    futures[executor.submit(extract_audio_segment, vp, Path(tmp_audio_dir), idx, 16000, start, segment_time, ffmpeg_threads)] = idx
-
-                for future in tqdm(as_completed(futures), total=len(futures), desc=f"Transcribing {video_id}", unit="seg", leave=False):
-                    idx = futures[future]
-                    audio_path = future.result()
-                    if eng_name == "faster-whisper":
-                        gen = transcribe_faster(eng_obj, audio_path, language)
-                    elif eng_name == "mslite":
-                        gen = transcribe_mslite(eng_obj, audio_path, language)
-                    else:
-                        gen = transcribe_whisper(eng_obj, audio_path, language)
-                    for seg in gen:
-                        rec = {
-                            "id": str(uuid4()),
-                            "video_id": video_id,
-                            "segment_id": f"{idx}_{seg['segment_id']}",
-                            "start_ms": seg["start_ms"] + idx * segment_time * 1000,
-                            "end_ms": seg["end_ms"] + idx * segment_time * 1000,
-                            "src": seg["text"]
-                        }
-                        f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    pending = deque()
+    running = deque()
+    with open(out_jsonl, "wb") as f:
+        try:
+            pending.extend(submit_decode(i) for i in range(min(max_workers, len(vps))))
+            for i, vp in enumerate(tqdm(vps, desc="Videos", unit="video")):
+                audio = pending.popleft().result()
+                if i + max_workers < len(vps):
+                    pending.append(submit_decode(i + max_workers))
+                running.append(asr_executor.submit(transcribe_video, vp, audio))
+                # 每个视频转写完整体落盘一次，中途失败时已完成的视频不丢
+                if len(running) >= num_workers:
+                    f.write(running.popleft().result())
+            while running:
+                f.write(running.popleft().result())
+        finally:
+            # 线程池跨调用复用，中途出错时撤掉还没开始的预解码与转写
+            for fu in (*pending, *running):
+                fu.cancel()
 
 def collect_videos(path):
     p = Path(path)
@@ -135,13 +298,14 @@ def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--input", required=True)
     ap.add_argument("--out", default="out/train.jsonl")
-    ap.add_argument("--tmp_audio_dir", default="tmp_audio")
     ap.add_argument("--engine", default="auto", choices=["auto", "faster-whisper", "whisper", "mslite"])
     ap.add_argument("--model_size", default="medium")
     ap.add_argument("--device", default="cuda")
-    ap.add_argument("--compute_type", default="float16")
+    ap.add_argument("--compute_type", default="int8_float16", help="auto 时按硬件自动选择")
     ap.add_argument("--language", default="zh")
+    ap.add_argument("--tmp_audio_dir", default="tmp_audio", help="长音频解码结果的临时转存目录（为空则全部留在内存）")
     ap.add_argument("--segment_time", default=120, type=int, help="每段切片时长（秒）")
+    ap.add_argument("--batch_size", default=16, type=int, help="faster-whisper 批量推理的 batch 大小")
     args = ap.parse_args()
 
     videos = collect_videos(args.input)
@@ -149,8 +313,8 @@ def main():
         print("No videos found in:", args.input, file=sys.stderr)
         sys.exit(1)
 
-    build_dataset(videos, args.out, args.tmp_audio_dir, args.engine, args.model_size, args.device,
-                  args.compute_type, args.language, args.segment_time)
+    build_dataset(videos, args.out, args.tmp_audio_dir or None, args.engine, args.model_size, args.device,
+                  args.compute_type, args.language, args.segment_time, batch_size=args.batch_size)
 
 if __name__ == "__main__":
     main()
@@ -3,97 +3,115 @@ import argparse
 import json
 import re
 from pathlib import Path
+import numpy as np
+
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+def _dumps_line(rec):
+    if orjson is not None:
+        return orjson.dumps(rec) + b"\n"
+    return (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
 
 KEY_PHRASES = [
     "接下来我们讲", "接下来讲", "接着我们讲", "下一部分是", "下一节是", "这一节我们讲",
     "本章内容", "首先我们", "其次我们", "然后我们", "最后我们", "总结一下", "小结"
 ]
 
+_PHRASE_RE = re.compile("|".join(map(re.escape, KEY_PHRASES)))
+
+def _para_key(p):
+    return (p.get("video_id"), int(p.get("start_ms", 0)))
+
 def load_paragraphs(path):
     paras = []
-    with open(path, "r", encoding="utf-8") as f:
+    loads = orjson.loads if orjson is not None else json.loads
+    with open(path, "rb") as f:
         for line in f:
             try:
-                obj = json.loads(line)
+                obj = loads(line)
                 if all(k in obj for k in ("video_id", "start_ms", "end_ms", "text")):
                     paras.append(obj)
             except Exception:
                 continue
-    paras.sort(key=lambda x: (x.get("video_id"), int(x.get("start_ms", 0))))
+    # clean_text 按视频分组且组内按时间排序输出，通常已有序，线性检查一遍即可省掉排序
+    keys = [_para_key(p) for p in paras]
+    if any(a > b for a, b in zip(keys, keys[1:])):
+        paras.sort(key=_para_key)
     return paras
 
 def score_break(prev, cur, min_gap_ms, min_len_chars):
     gap = int(cur.get("start_ms", 0)) - int(prev.get("end_ms", 0))
     gap_score = 1 if gap >= min_gap_ms else 0
     len_score = 1 if len(cur.get("text", "")) >= min_len_chars else 0
-    phrase = cur.get("text", "")
-    phrase_score = 1 if any(kw in phrase for kw in KEY_PHRASES) else 0
+    phrase_score = 1 if _PHRASE_RE.search(cur.get("text", "")) else 0
     return gap_score + len_score + phrase_score
 
+def break_points(paras, min_gap_ms=10000, min_len_chars=100, threshold=2):
+    """一次性为所有相邻段落打分（同 score_break），返回需要在其前断开章节的段落下标"""
+    n = len(paras)
+    if n < 2:
+        return np.zeros(0, dtype=np.int64)
+    starts = np.fromiter((int(p.get("start_ms", 0)) for p in paras), dtype=np.int64, count=n)
+    ends = np.fromiter((int(p.get("end_ms", 0)) for p in paras), dtype=np.int64, count=n)
+    lens = np.fromiter((len(p.get("text", "")) for p in paras), dtype=np.int64, count=n)
+    phrase = np.fromiter((_PHRASE_RE.search(p.get("text", "")) is not None for p in paras), dtype=bool, count=n)
+    score = (starts[1:] - ends[:-1] >= min_gap_ms).astype(np.int8)
+    score += lens[1:] >= min_len_chars
+    score += phrase[1:]
+    return np.flatnonzero(score >= threshold) + 1
+
 def segment_chapters(paras, min_gap_ms=10000, min_len_chars=100, threshold=2):
+    if not paras:
+        return []
     chapters = []
-    cur = {"title": None, "items": [], "start_ms": None, "end_ms": None}
-    chapter_id = 1
-    for i, p in enumerate(paras):
-        if not cur["items"]:
-            cur["items"].append(p)
-            cur["start_ms"] = int(p.get("start_ms", 0))
-            cur["end_ms"] = int(p.get("end_ms", 0))
-            continue
-        prev = cur["items"][-1]
-        sc = score_break(prev, p, min_gap_ms, min_len_chars)
-        if sc >= threshold:
-            title = infer_title(cur["items"]) or f"Chapter {chapter_id}"
-            chapters.append({
-                "chapter_id": chapter_id,
-                "title": title,
-                "start_ms": cur["start_ms"],
-                "end_ms": cur["end_ms"],
-                "items": cur["items"],
-            })
-            chapter_id += 1
-            cur = {"title": None, "items": [p], "start_ms": int(p.get("start_ms", 0)), "end_ms": int(p.get("end_ms", 0))}
-        else:
-            cur["items"].append(p)
-            cur["end_ms"] = int(p.get("end_ms", 0))
-    if cur["items"]:
-        title = infer_title(cur["items"]) or f"Chapter {chapter_id}"
+    bounds = [0, *break_points(paras, min_gap_ms, min_len_chars, threshold).tolist(), len(paras)]
+    for chapter_id, (lo, hi) in enumerate(zip(bounds, bounds[1:]), 1):
+        items = paras[lo:hi]
+        title = infer_title(items) or f"Chapter {chapter_id}"
         chapters.append({
             "chapter_id": chapter_id,
             "title": title,
-            "start_ms": cur["start_ms"],
-            "end_ms": cur["end_ms"],
-            "items": cur["items"],
+            "start_ms": int(items[0].get("start_ms", 0)),
+            "end_ms": int(items[-1].get("end_ms", 0)),
+            "items": items,
         })
     return chapters
 
+_TITLE_TOPIC_RE = re.compile(r"(单调性|周期性|连续|极限|原函数与导函数|原函数|导函数|积分|微分|不等式|函数性质)")
+_TITLE_PUNCT_RE = re.compile(r"[，。！？、]")
+
 def infer_title(items):
     for it in items:
-        t = it.get("text", "")
-        m = re.search(r"(单调性|周期性|连续|极限|原函数与导函数|原函数|导函数|积分|微分|不等式|函数性质)", t)
+        m = _TITLE_TOPIC_RE.search(it.get("text", ""))
         if m:
             return m.group(1)
     for it in items:
         t = it.get("text", "")
+        # 一次扫描先排除不含任何关键短语的段落；命中时仍按 KEY_PHRASES 的优先级取标题
+        if not _PHRASE_RE.search(t):
+            continue
         for kw in KEY_PHRASES:
             if kw in t:
                 tail = t.split(kw, 1)[-1]
-                tail = re.sub(r"[，。！？、]", " ", tail).strip()
+                tail = _TITLE_PUNCT_RE.sub(" ", tail).strip()
                 if tail:
                     return tail[:20]
     return None
 
 def write_chapters(chapters, out_path):
     Path(out_path).parent.mkdir(parents=True, exist_ok=True)
-    with open(out_path, "w", encoding="utf-8") as f:
+    with open(out_path, "wb") as f:
         for ch in chapters:
-            f.write(json.dumps({
+            f.write(_dumps_line({
                 "chapter_id": ch["chapter_id"],
                 "title": ch["title"],
                 "start_ms": ch["start_ms"],
                 "end_ms": ch["end_ms"],
                 "items": [{"start_ms": it["start_ms"], "end_ms": it["end_ms"], "text": it["text"]} for it in ch["items"]]
-            }, ensure_ascii=False) + "\n")
+            }))
 
 def format_time(ms):
     """将毫秒转换为时分秒格式"""
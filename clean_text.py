@@ -1,68 +1,82 @@
 #!/usr/bin/env python3
 import argparse
 import json
+import mmap
+import multiprocessing
+import os
 import re
 import sys
 from pathlib import Path
 import unicodedata
 
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+def _dumps_line(rec):
+    if orjson is not None:
+        return orjson.dumps(rec) + b"\n"
+    return (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+
 def load_jsonl(paths):
     items = []
+    loads = orjson.loads if orjson is not None else json.loads
     for p in paths:
-        with open(p, "r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                try:
-                    obj = json.loads(line)
+        with open(p, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                continue
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for line in iter(mm.readline, b""):
+                    try:
+                        obj = loads(line)
+                    except Exception:
+                        continue
                     if isinstance(obj, dict) and "src" in obj:
                         items.append(obj)
-                except Exception:
-                    continue
     return items
 
 FILLERS = ["然后", "就是", "那么", "那个", "这个", "对吧", "你知道", "我觉得", "其实", "好吧", "呃", "嗯", "啊", "嘛", "吧", "呢"]
 
+_WS_RE = re.compile(r"\s+")
+_BULLET_RE = re.compile(r"[·••]+")
+_NOISE_TAG_RE = re.compile(r"\[(?:音乐|掌声|笑声|旁白|杂音)\]|\((?:音乐|掌声|笑声|旁白|杂音)\)")
+_STUTTER_RE = re.compile(r"[呃嗯啊]{2,}")
+# 语气词两侧用环视判断空白，不吞掉分隔空格，相邻的多个语气词一次扫描即可全部去除
+_FILLERS_RE = re.compile(r"(?<!\S)(?:" + "|".join(map(re.escape, FILLERS)) + r")(?!\S)")
+_END_PUNCT_RE = re.compile(r"[。！？.!?]$")
+_QUESTION_TAIL_RE = re.compile(r"[吗呢吧啊嘛]$")
+
 def normalize_text(s):
     s = unicodedata.normalize("NFKC", s)
-    s = re.sub(r"\s+", " ", s).strip()
-    s = re.sub(r"[·••]+", "", s)
-    s = re.sub(r"\[(?:音乐|掌声|笑声|旁白|杂音)\]", "", s)
-    s = re.sub(r"\((?:音乐|掌声|笑声|旁白|杂音)\)", "", s)
-    s = re.sub(r"[呃嗯啊]{2,}", "", s)
-    for w in FILLERS:
-        s = re.sub(rf"(?:^|\s){re.escape(w)}(?:$|\s)", " ", s)
-    s = re.sub(r"\s+", " ", s).strip()
+    s = _WS_RE.sub(" ", s).strip()
+    s = _BULLET_RE.sub("", s)
+    s = _NOISE_TAG_RE.sub("", s)
+    s = _STUTTER_RE.sub("", s)
+    s = _FILLERS_RE.sub(" ", s)
+    s = _WS_RE.sub(" ", s).strip()
     return s
 
 def ends_with_punct(s):
-    return bool(re.search(r"[。！？.!?]$", s))
+    return bool(_END_PUNCT_RE.search(s))
 
 def autopunct(s):
     if not s:
         return s
     if not ends_with_punct(s):
-        if re.search(r"[吗呢吧啊嘛]$", s):
+        if _QUESTION_TAIL_RE.search(s):
             return s + "？"
         return s + "。"
     return s
 
+_SENT_SPLIT_RE = re.compile(r"(?<=[。！？.!?])")
+
 def split_sentences(s):
-    parts = []
-    i = 0
-    buf = []
-    for ch in s:
-        buf.append(ch)
-        if ch in "。！？.!?":
-            part = "".join(buf).strip()
-            if part:
-                parts.append(part)
-            buf = []
-    if buf:
-        tail = "".join(buf).strip()
-        if tail:
-            parts.append(autopunct(tail))
+    *heads, tail = _SENT_SPLIT_RE.split(s)
+    parts = [p for p in map(str.strip, heads) if p]
+    tail = tail.strip()
+    if tail:
+        parts.append(autopunct(tail))
     return parts
 
 def group_by_video(items):
@@ -77,6 +91,7 @@ def group_by_video(items):
 def merge_segments(segments, min_chars, max_gap_ms):
     paragraphs = []
     cur_texts = []
+    cur_len = 0
     cur_start = None
     cur_end = None
     last_end = None
@@ -87,7 +102,7 @@ def merge_segments(segments, min_chars, max_gap_ms):
         gap_ok = True
         if last_end is not None:
             gap_ok = int(seg.get("start_ms", 0)) - int(last_end) <= max_gap_ms
-        if cur_texts and (not gap_ok) and (len("".join(cur_texts)) >= min_chars):
+        if cur_texts and (not gap_ok) and (cur_len >= min_chars):
             paragraphs.append({
                 "video_id": seg.get("video_id"),
                 "start_ms": cur_start,
@@ -95,14 +110,16 @@ def merge_segments(segments, min_chars, max_gap_ms):
                 "text": finalize_paragraph("".join(cur_texts))
             })
             cur_texts = []
+            cur_len = 0
             cur_start = None
             cur_end = None
         if not cur_texts:
             cur_start = int(seg.get("start_ms", 0))
         cur_texts.append(t + " ")
+        cur_len += len(t) + 1
         cur_end = int(seg.get("end_ms", 0))
         last_end = cur_end
-        if len("".join(cur_texts)) >= min_chars:
+        if cur_len >= min_chars:
             paragraphs.append({
                 "video_id": seg.get("video_id"),
                 "start_ms": cur_start,
@@ -110,6 +127,7 @@ def merge_segments(segments, min_chars, max_gap_ms):
                 "text": finalize_paragraph("".join(cur_texts))
             })
             cur_texts = []
+            cur_len = 0
             cur_start = None
             cur_end = None
             last_end = None
@@ -122,25 +140,31 @@ def merge_segments(segments, min_chars, max_gap_ms):
         })
     return paragraphs
 
+_REPEAT_COMMA_RE = re.compile(r"[，]{2,}")
+_REPEAT_PERIOD_RE = re.compile(r"[。]{2,}")
+
 def to_chinese_punct(s):
     s = s.replace("?", "？").replace("!", "！").replace(",", "，").replace(".", "。")
-    s = re.sub(r"[，]{2,}", "，", s)
-    s = re.sub(r"[。]{2,}", "。", s)
+    s = _REPEAT_COMMA_RE.sub("，", s)
+    s = _REPEAT_PERIOD_RE.sub("。", s)
     return s
 
 KEYWORDS_PAUSE = ["所以", "因此", "但是", "不过", "然后", "接着", "首先", "其次", "最后", "总之", "此外"]
 
+_PAUSE_RES = [(re.compile(rf"(?<![，。！？]){w}"), f"，{w}") for w in KEYWORDS_PAUSE]
+_REPEAT_PUNCT_RE = re.compile(r"([，。！？])\1+")
+
 def refine_style_student(s):
     s = to_chinese_punct(s)
-    for w in KEYWORDS_PAUSE:
-        s = re.sub(rf"(?<![，。！？]){w}", f"，{w}", s)
-    s = re.sub(r"\s+", "", s)
-    s = re.sub(r"([，。！？])\1+", r"\1", s)
+    for pat, repl in _PAUSE_RES:
+        s = pat.sub(repl, s)
+    s = _WS_RE.sub("", s)
+    s = _REPEAT_PUNCT_RE.sub(r"\1", s)
     return s
 
 def finalize_paragraph(s, style="plain"):
     s = s.strip()
-    s = re.sub(r"\s+", " ", s)
+    s = _WS_RE.sub(" ", s)
     sents = []
     for part in split_sentences(s):
         part = autopunct(normalize_text(part))
@@ -150,23 +174,33 @@ def finalize_paragraph(s, style="plain"):
         out = refine_style_student(out)
     return out
 
+def _clean_one_video(vid, segs, min_chars, max_gap_ms, style):
+    paras = merge_segments(segs, min_chars=min_chars, max_gap_ms=max_gap_ms)
+    return [{
+        "video_id": vid,
+        "paragraph_id": i,
+        "start_ms": p["start_ms"],
+        "end_ms": p["end_ms"],
+        "text": finalize_paragraph(p["text"], style=style)
+    } for i, p in enumerate(paras)]
+
 def process_files(inputs, output, min_chars, max_gap_ms, style="plain"):
     items = load_jsonl(inputs)
     groups = group_by_video(items)
+    jobs = [(vid, segs, min_chars, max_gap_ms, style) for vid, segs in groups.items()]
+    # 各视频互不相关，多个视频时按进程并行清洗，写入仍在主进程按原顺序进行；
+    # 用 spawn 起子进程：web_app 会在多线程（可能已持有 CUDA/锁状态）的进程里调用，fork 不安全
+    if len(jobs) > 1:
+        with multiprocessing.get_context("spawn").Pool(min(len(jobs), os.cpu_count() or 1)) as pool:
+            results = pool.starmap(_clean_one_video, jobs)
+    else:
+        results = [_clean_one_video(*job) for job in jobs]
     outp = Path(output)
     outp.parent.mkdir(parents=True, exist_ok=True)
-    with open(outp, "w", encoding="utf-8") as f:
-        for vid, segs in groups.items():
-            paras = merge_segments(segs, min_chars=min_chars, max_gap_ms=max_gap_ms)
-            for i, p in enumerate(paras):
-                rec = {
-                    "video_id": vid,
-                    "paragraph_id": i,
-                    "start_ms": p["start_ms"],
-                    "end_ms": p["end_ms"],
-                    "text": finalize_paragraph(p["text"], style=style)
-                }
-                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    with open(outp, "wb") as f:
+        for recs in results:
+            for rec in recs:
+                f.write(_dumps_line(rec))
 
 def create_app():
     from fastapi import FastAPI
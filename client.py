@@ -1,37 +1,47 @@
 #!/usr/bin/env python3
 import argparse
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import json
 
-import build_dataset as bd
-import clean_text as ct
-import chapter_segmenter as cs
-import summarizer as sz
-import summarize_chapters as sc
-import llm_analyzer as la
+# 各阶段模块在对应的 run_* 里按需导入：--help、--skip_asr 等用不到 ASR 的调用不必加载 numpy / ASR 相关依赖
 
 def ensure_dirs(outdir, cleanout, finalout):
     Path(outdir).mkdir(parents=True, exist_ok=True)
     Path(cleanout).mkdir(parents=True, exist_ok=True)
     Path(finalout).mkdir(parents=True, exist_ok=True)
 
-def run_asr(videos, out_jsonl, tmp_audio_dir, engine, model_size, device, compute_type, language, segment_time):
+def _cuda_device_count():
+    try:
+        import ctranslate2
+        return ctranslate2.get_cuda_device_count()
+    except Exception:
+        return 0
+
+def run_asr(videos, out_jsonl, tmp_audio_dir, engine, model_size, device, compute_type, language, segment_time, batch_size=16):
+    import build_dataset as bd
     vids = bd.collect_videos(videos)
     if not vids:
         print("no videos found", file=sys.stderr)
         sys.exit(1)
+    # 多卡时一个模型铺到所有卡上，每张卡一个转写线程，多个视频数据并行
+    n_gpu = _cuda_device_count() if device == "cuda" else 0
+    device_index, num_workers = (list(range(n_gpu)), n_gpu) if n_gpu > 1 else (0, 1)
     try:
         fast = (engine == "faster-whisper" and model_size in ("small", "base"))
-        bd.build_dataset(vids, out_jsonl, tmp_audio_dir, engine, model_size, device, compute_type, language, segment_time, max_workers=8 if fast else 4, ffmpeg_threads=4 if fast else 2)
+        bd.build_dataset(vids, out_jsonl, tmp_audio_dir, engine, model_size, device, compute_type, language, segment_time, ffmpeg_threads=4 if fast else 2, batch_size=batch_size,
+                         device_index=device_index, num_workers=num_workers)
     except Exception:
         print("gpu unavailable, fallback to cpu", file=sys.stderr)
-        bd.build_dataset(vids, out_jsonl, tmp_audio_dir, engine, model_size, "cpu", "float32", language, segment_time, max_workers=4, ffmpeg_threads=2)
+        bd.build_dataset(vids, out_jsonl, tmp_audio_dir, engine, model_size, "cpu", "int8", language, segment_time, ffmpeg_threads=2, batch_size=batch_size)
 
 def run_clean(train_jsonl, clean_paragraphs, min_chars, max_gap_ms, style):
+    import clean_text as ct
     ct.process_files([train_jsonl], clean_paragraphs, min_chars, max_gap_ms, style=style)
 
 def run_chapters(clean_paragraphs, chapters_jsonl, min_gap_ms, min_len_chars, threshold, text_format=False):
+    import chapter_segmenter as cs
     paras = cs.load_paragraphs(clean_paragraphs)
     chs = cs.segment_chapters(paras, min_gap_ms=min_gap_ms, min_len_chars=min_len_chars, threshold=threshold)
     cs.write_chapters(chs, chapters_jsonl)
@@ -41,29 +51,65 @@ def run_chapters(clean_paragraphs, chapters_jsonl, min_gap_ms, min_len_chars, th
         text_path = str(Path(chapters_jsonl).with_suffix('')) + "_text.txt"
         cs.write_chapters_text(chs, text_path)
 
+SUMMARY_JSONL = ("micro_summary", "chapter_summary", "global_summary", "chapters_summary", "chapters_summary_exam")
+SUMMARY_TEXT = ("micro_summary_txt", "chapter_summary_txt", "global_summary_txt", "chapters_summary_text", "chapters_summary_exam_text")
+
+def summary_paths(finalout):
+    """finalout 下各输出文件路径一次算好，run_summaries 与清单共用"""
+    fo = Path(finalout)
+    names = {
+        "micro_summary": "micro_summary.jsonl",
+        "chapter_summary": "chapter_summary.jsonl",
+        "global_summary": "global_summary.jsonl",
+        "chapters_summary": "chapters_summary.jsonl",
+        "chapters_summary_exam": "chapters_summary_exam.jsonl",
+        "micro_summary_txt": "micro_summary.txt",
+        "chapter_summary_txt": "chapter_summary.txt",
+        "global_summary_txt": "global_summary.txt",
+        "chapters_summary_text": "chapters_summary_text.txt",
+        "chapters_summary_exam_text": "chapters_summary_exam_text.txt",
+        "focus_analysis": "focus_analysis.jsonl",
+        "focus_analysis_text": "focus_analysis_text.txt",
+    }
+    return {k: str(fo / v) for k, v in names.items()}
+
 def run_summaries(train_jsonl, chapters_jsonl, finalout, window_sec, exam, text_format=False):
+    import summarizer as sz
+    import summarize_chapters as sc
     segs = sz.load_segments(train_jsonl)
     chs = sz.load_chapters(chapters_jsonl)
     micro = sz.micro_summaries(segs, window_sec=window_sec, exam=exam)
     chap = sz.chapter_summaries(chs)
     glob = sz.global_summary(chs, exam=exam)
+    paths = summary_paths(finalout)
     
-    # 始终生成JSON格式
-    sz.write_jsonl(micro, str(Path(finalout) / "micro_summary.jsonl"))
-    sz.write_jsonl(chap, str(Path(finalout) / "chapter_summary.jsonl"))
-    sz.write_jsonl([glob], str(Path(finalout) / "global_summary.jsonl"))
-    sc.write_summaries(chs, str(Path(finalout) / "chapters_summary_exam.jsonl"), style="exam")
-    sc.write_summaries(chs, str(Path(finalout) / "chapters_summary.jsonl"), style="plain")
-    
-    # 可选生成文本格式
-    if text_format:
-        sz.write_text(micro, str(Path(finalout) / "micro_summary.txt"))
-        sz.write_text(chap, str(Path(finalout) / "chapter_summary.txt"))
-        sz.write_text([glob], str(Path(finalout) / "global_summary.txt"))
-        sc.write_summaries_text(chs, str(Path(finalout) / "chapters_summary_text.txt"), style="plain")
-        sc.write_summaries_text(chs, str(Path(finalout) / "chapters_summary_exam_text.txt"), style="exam")
+    # 各输出文件互不依赖，放进线程池并发写，最后统一等待（并抛出其中的异常）
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        # 始终生成JSON格式
+        futs = [
+            ex.submit(sz.write_jsonl, micro, paths["micro_summary"]),
+            ex.submit(sz.write_jsonl, chap, paths["chapter_summary"]),
+            ex.submit(sz.write_jsonl, [glob], paths["global_summary"]),
+            ex.submit(sc.write_summaries, chs, paths["chapters_summary_exam"], style="exam"),
+            ex.submit(sc.write_summaries, chs, paths["chapters_summary"], style="plain"),
+        ]
+
+        # 可选生成文本格式
+        if text_format:
+            futs += [
+                ex.submit(sz.write_text, micro, paths["micro_summary_txt"]),
+                ex.submit(sz.write_text, chap, paths["chapter_summary_txt"]),
+                ex.submit(sz.write_text, [glob], paths["global_summary_txt"]),
+                ex.submit(sc.write_summaries_text, chs, paths["chapters_summary_text"], style="plain"),
+                ex.submit(sc.write_summaries_text, chs, paths["chapters_summary_exam_text"], style="exam"),
+            ]
+        for fu in futs:
+            fu.result()
+    # 把刚写出的记录一并返回，调用方（web_app）不必再从磁盘读回
+    return {"micro_summary": micro, "chapter_summary": chap, "global_summary": [glob]}
 
 def run_llm_analysis(clean_paragraphs, analysis_jsonl, api_key, base_url, model, text_format=False, dry_run=False):
+    import llm_analyzer as la
     la.analyze_file(clean_paragraphs, analysis_jsonl, api_key=api_key, base_url=base_url, model=model, dry_run=dry_run)
     
     # 可选生成文本格式
@@ -77,13 +123,14 @@ def main():
     ap.add_argument("--outdir", default="out")
     ap.add_argument("--cleanout", default="cleanout")
     ap.add_argument("--finalout", default="finalout")
-    ap.add_argument("--tmp_audio_dir", default="tmp_audio")
+    ap.add_argument("--tmp_audio_dir", default="tmp_audio", help="长音频解码结果的临时转存目录（为空则全部留在内存）")
     ap.add_argument("--engine", default="auto")
     ap.add_argument("--model_size", default="medium")
     ap.add_argument("--device", default="cuda")
-    ap.add_argument("--compute_type", default="float16")
+    ap.add_argument("--compute_type", default="int8_float16", help="auto 时按硬件自动选择")
     ap.add_argument("--language", default="zh")
     ap.add_argument("--segment_time", type=int, default=120)
+    ap.add_argument("--batch_size", type=int, default=16, help="faster-whisper 批量推理的 batch 大小")
     ap.add_argument("--min_chars", type=int, default=200)
     ap.add_argument("--max_gap_ms", type=int, default=1500)
     ap.add_argument("--style", default="student")
@@ -107,7 +154,7 @@ def main():
         if not args.videos:
             print("missing --videos for ASR", file=sys.stderr)
             sys.exit(1)
-        run_asr(args.videos, train_jsonl, args.tmp_audio_dir, args.engine, args.model_size, args.device, args.compute_type, args.language, args.segment_time)
+        run_asr(args.videos, train_jsonl, args.tmp_audio_dir or None, args.engine, args.model_size, args.device, args.compute_type, args.language, args.segment_time, args.batch_size)
 
     clean_paragraphs = str(Path(args.cleanout) / "clean_paragraphs.jsonl")
     run_clean(train_jsonl, clean_paragraphs, args.min_chars, args.max_gap_ms, args.style)
@@ -116,11 +163,11 @@ def main():
     run_chapters(clean_paragraphs, chapters_jsonl, args.min_gap_chapter_ms, args.min_len_chapter_chars, args.chapter_threshold, args.text_format)
 
     run_summaries(train_jsonl, chapters_jsonl, args.finalout, args.window_sec, args.exam, args.text_format)
+    paths = summary_paths(args.finalout)
 
     # LLM分析（可选）
     if args.llm_api_key:
-        analysis_jsonl = str(Path(args.finalout) / "focus_analysis.jsonl")
-        run_llm_analysis(clean_paragraphs, analysis_jsonl, args.llm_api_key, args.llm_base_url, args.llm_model, args.text_format)
+        run_llm_analysis(clean_paragraphs, paths["focus_analysis"], args.llm_api_key, args.llm_base_url, args.llm_model, args.text_format)
 
     manifest = {
         "out": {
@@ -130,32 +177,18 @@ def main():
         "cleanout": {
             "clean_paragraphs": clean_paragraphs
         },
-        "finalout": {
-            "micro_summary": str(Path(args.finalout) / "micro_summary.jsonl"),
-            "chapter_summary": str(Path(args.finalout) / "chapter_summary.jsonl"),
-            "global_summary": str(Path(args.finalout) / "global_summary.jsonl"),
-            "chapters_summary": str(Path(args.finalout) / "chapters_summary.jsonl"),
-            "chapters_summary_exam": str(Path(args.finalout) / "chapters_summary_exam.jsonl"),
-        }
+        "finalout": {k: paths[k] for k in SUMMARY_JSONL}
     }
     
     # 添加文本格式文件到清单
     if args.text_format:
-        manifest["out"].update({
-            "chapters_text": str(Path(args.outdir) / "chapters_text.txt")
-        })
-        manifest["finalout"].update({
-            "micro_summary_txt": str(Path(args.finalout) / "micro_summary.txt"),
-            "chapter_summary_txt": str(Path(args.finalout) / "chapter_summary.txt"),
-            "global_summary_txt": str(Path(args.finalout) / "global_summary.txt"),
-            "chapters_summary_text": str(Path(args.finalout) / "chapters_summary_text.txt"),
-            "chapters_summary_exam_text": str(Path(args.finalout) / "chapters_summary_exam_text.txt"),
-        })
+        manifest["out"]["chapters_text"] = str(Path(args.outdir) / "chapters_text.txt")
+        manifest["finalout"].update((k, paths[k]) for k in SUMMARY_TEXT)
     
     if args.llm_api_key:
-        manifest["finalout"]["focus_analysis"] = str(Path(args.finalout) / "focus_analysis.jsonl")
+        manifest["finalout"]["focus_analysis"] = paths["focus_analysis"]
         if args.text_format:
-            manifest["finalout"]["focus_analysis_text"] = str(Path(args.finalout) / "focus_analysis_text.txt")
+            manifest["finalout"]["focus_analysis_text"] = paths["focus_analysis_text"]
     
     print(json.dumps(manifest, ensure_ascii=False))
 
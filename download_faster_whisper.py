@@ -3,7 +3,8 @@
 
 import os
 from pathlib import Path
-from faster_whisper import WhisperModel
+from faster_whisper import WhisperModel, BatchedInferencePipeline
+from build_dataset import resolve_compute_type
 from tqdm import tqdm
 try:
     from huggingface_hub import snapshot_download
@@ -14,10 +15,12 @@ except Exception:
 # ========== 配置 ==========
 MODEL_SIZE = "medium"   # 可选: tiny, base, small, medium, large, large-v3
 DEVICE = "cuda"         # 或 "cpu"
-COMPUTE_TYPE = "float16"  # float16 / int8 / float32
+COMPUTE_TYPE = "auto"     # auto（按硬件选择） / bfloat16 / int8_float16 / float16 / int8 / float32
+BATCH_SIZE = 16           # 批量推理的 batch 大小，显存不足时调小
 LOCAL_MODEL_DIR = Path("/home/clearpyh/models/faster-whisper")  # 本地存放目录
 # =========================
 
+COMPUTE_TYPE = resolve_compute_type(DEVICE, COMPUTE_TYPE)
 LOCAL_MODEL_DIR.mkdir(parents=True, exist_ok=True)
 model_path = LOCAL_MODEL_DIR / MODEL_SIZE
 
@@ -54,11 +57,14 @@ if model_path.exists():
 else:
     model = WhisperModel(MODEL_SIZE, device=DEVICE, compute_type=COMPUTE_TYPE, download_root=str(LOCAL_MODEL_DIR))
 
+# 与 build_dataset 一致，用批量推理管线包装模型（VAD 切块后按 batch 送 GPU）
+batched = BatchedInferencePipeline(model=model)
+
 # 简单测试离线加载
 test_audio = Path("test.wav")  # 可以放一个短音频文件测试
 if test_audio.exists():
     print("开始测试模型识别...")
-    segments, info = model.transcribe(str(test_audio), language="zh")
+    segments, info = batched.transcribe(str(test_audio), batch_size=BATCH_SIZE, language="zh")
     for seg in segments:
         print(f"[{seg.start:.2f}s - {seg.end:.2f}s] {seg.text}")
 else:
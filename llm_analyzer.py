@@ -1,9 +1,30 @@
+import base64
+import hashlib
+import http.client
 import json
+import mmap
+import os
 import re
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from urllib.request import Request, urlopen
 from urllib.error import URLError, HTTPError
+from urllib.parse import unquote, urlsplit
+import urllib.request
+
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+_loads = orjson.loads if orjson is not None else json.loads
+
+def _dumps_line(rec):
+    if orjson is not None:
+        return orjson.dumps(rec) + b"\n"
+    return (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
 
 # ==========================
 # 1. 更强 SYSTEM PROMPT
@@ -36,25 +57,23 @@ SYSTEM_PROMPT = """
 # ==========================
 # 2. 分句器（保持你原结构）
 # ==========================
+_END_PUNCT_RE = re.compile(r"[。！？.!?]$")
+_QUESTION_TAIL_RE = re.compile(r"[吗呢吧啊嘛]$")
+
+_SENT_SPLIT_RE = re.compile(r"(?<=[。！？.!?])")
+
 def _split_sentences(s):
-    parts = []
-    buf = []
-    for ch in s:
-        buf.append(ch)
-        if ch in "。！？.!?":
-            part = "".join(buf).strip()
-            if part:
-                parts.append(part)
-            buf = []
-    if buf:
-        tail = "".join(buf).strip()
-        if tail:
-            if not re.search(r"[。！？.!?]$", tail):
-                if re.search(r"[吗呢吧啊嘛]$", tail):
-                    tail += "？"
-                else:
-                    tail += "。"
-            parts.append(tail)
+    # 在每个句末标点之后切开，最后一块是未收尾的残句
+    *heads, tail = _SENT_SPLIT_RE.split(s)
+    parts = [p for p in map(str.strip, heads) if p]
+    tail = tail.strip()
+    if tail:
+        if not _END_PUNCT_RE.search(tail):
+            if _QUESTION_TAIL_RE.search(tail):
+                tail += "？"
+            else:
+                tail += "。"
+        parts.append(tail)
     return parts
 
 
@@ -104,14 +123,117 @@ def _heuristic_type(s):
 # ==========================
 # 4. HTTP 请求
 # ==========================
+# 每个线程按 (scheme, host) 保持一条 keep-alive 连接，TCP/TLS 握手只做一次
+_CONNS = threading.local()
+
+def _proxy_for(scheme, host):
+    # 与 urllib 一致：读取 HTTPS_PROXY / HTTP_PROXY，并遵守 NO_PROXY
+    proxy = urllib.request.getproxies().get(scheme)
+    if not proxy or urllib.request.proxy_bypass(host):
+        return None
+    return urlsplit(proxy if "://" in proxy else "http://" + proxy)
+
+def _get_conn(scheme, netloc, timeout):
+    """返回 (连接, 请求行是否需要写完整 URL)；经 HTTP 代理访问 http 时请求行要带完整 URL"""
+    conns = _CONNS.__dict__.setdefault("conns", {})
+    entry = conns.get((scheme, netloc))
+    if entry is None:
+        cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        target = urlsplit(f"{scheme}://{netloc}")
+        proxy = _proxy_for(scheme, target.hostname or "")
+        if proxy is None:
+            entry = (cls(netloc, timeout=timeout), False, {})
+        else:
+            auth = {}
+            if proxy.username:
+                cred = f"{unquote(proxy.username)}:{unquote(proxy.password or '')}".encode("utf-8")
+                auth["Proxy-Authorization"] = "Basic " + base64.b64encode(cred).decode("ascii")
+            if scheme == "https":
+                # 经代理 CONNECT 建隧道，TLS 仍直接与目标主机握手
+                conn = cls(proxy.hostname, proxy.port or 8080, timeout=timeout)
+                conn.set_tunnel(target.hostname, target.port or 443, headers=auth)
+                entry = (conn, False, {})
+            else:
+                entry = (http.client.HTTPConnection(proxy.hostname, proxy.port or 8080, timeout=timeout), True, auth)
+        conns[(scheme, netloc)] = entry
+    return entry
+
+def _drop_conn(scheme, netloc):
+    entry = _CONNS.__dict__.get("conns", {}).pop((scheme, netloc), None)
+    if entry is not None:
+        entry[0].close()
+
 def _http_post(url, headers, payload, timeout=60):
-    data = json.dumps(payload).encode("utf-8")
-    req = Request(url, data=data, headers=headers, method="POST")
-    with urlopen(req, timeout=timeout) as resp:
-        return resp.read().decode("utf-8")
+    data = orjson.dumps(payload) if orjson is not None else json.dumps(payload).encode("utf-8")
+    u = urlsplit(url)
+    path = (u.path or "/") + (f"?{u.query}" if u.query else "")
+    # 复用的 keep-alive 连接可能已被服务端关掉：只有复用连接在发送时失败，或服务端未响应就断开
+    # （RemoteDisconnected / BadStatusLine）时才重连重试一次；超时或已开始读响应后的失败不重试，
+    # 避免同一个计费请求被提交两次
+    for attempt in range(2):
+        conn, absolute, extra = _get_conn(u.scheme, u.netloc, timeout)
+        reused = conn.sock is not None
+        try:
+            conn.request("POST", url if absolute else path, body=data, headers={**headers, **extra})
+        except (http.client.HTTPException, OSError) as e:
+            _drop_conn(u.scheme, u.netloc)
+            if attempt or not reused or isinstance(e, TimeoutError):
+                raise
+            continue
+        try:
+            resp = conn.getresponse()
+            body = resp.read()
+        except (http.client.HTTPException, OSError) as e:
+            _drop_conn(u.scheme, u.netloc)
+            if attempt or not reused or not isinstance(e, (http.client.RemoteDisconnected, http.client.BadStatusLine)):
+                raise
+            continue
+        if resp.will_close:
+            _drop_conn(u.scheme, u.netloc)
+        if resp.status >= 400:
+            raise HTTPError(url, resp.status, resp.reason, resp.headers, None)
+        return body.decode("utf-8")
+
+
+LLM_CACHE_DIR = Path.home() / ".cache" / "sageagent" / "llm"
+
+def _cache_enabled():
+    return os.environ.get("SAGEAGENT_LLM_CACHE", "").lower() not in ("off", "0", "false")
+
+def _cache_path(system_prompt, user_prompt, model):
+    key = hashlib.sha256("\0".join((model, system_prompt, user_prompt)).encode("utf-8")).hexdigest()
+    return LLM_CACHE_DIR / f"{key}.txt"
+
+def _cache_get(path):
+    try:
+        return path.read_text(encoding="utf-8")
+    except OSError:
+        return None
 
+def _cache_put(path, content):
+    # 先写临时文件再 os.replace，并发线程或中途退出都不会留下半截缓存
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=path.parent, delete=False) as tmp:
+            tmp.write(content)
+        os.replace(tmp.name, path)
+    except OSError:
+        pass
 
 def _call_deepseek(system_prompt, user_prompt, api_key, base_url, model):
+    # 同一模型 + 提示词的结果落盘缓存（~/.cache/sageagent/llm），重跑时不再重复请求；
+    # SAGEAGENT_LLM_CACHE=off 关闭
+    cache = _cache_path(system_prompt, user_prompt, model) if _cache_enabled() else None
+    if cache is not None:
+        hit = _cache_get(cache)
+        if hit is not None:
+            return hit
+    content = _request_deepseek(system_prompt, user_prompt, api_key, base_url, model)
+    if cache is not None and content:
+        _cache_put(cache, content)
+    return content
+
+def _request_deepseek(system_prompt, user_prompt, api_key, base_url, model):
     url = base_url.rstrip("/") + "/chat/completions"
     headers = {
         "Authorization": f"Bearer {api_key}",
@@ -127,7 +249,7 @@ def _call_deepseek(system_prompt, user_prompt, api_key, base_url, model):
     }
     try:
         body = _http_post(url, headers, payload)
-        obj = json.loads(body)
+        obj = _loads(body)
         content = obj.get("choices", [{}])[0].get("message", {}).get("content", "")
         return content
     except Exception:
@@ -138,14 +260,17 @@ def _call_deepseek(system_prompt, user_prompt, api_key, base_url, model):
 # ==========================
 # 5. JSON 提取器（更聪明）
 # ==========================
+_FENCE_OPEN_RE = re.compile(r"^```json")
+_FENCE_CLOSE_RE = re.compile(r"```$")
+
 def _extract_json_array(text):
     if not text:
         return None
 
     # 先清理：“```json ... ```” 类格式
     text = text.strip()
-    text = re.sub(r"^```json", "", text)
-    text = re.sub(r"```$", "", text)
+    text = _FENCE_OPEN_RE.sub("", text)
+    text = _FENCE_CLOSE_RE.sub("", text)
     text = text.strip()
 
     # 直接解析
@@ -231,56 +356,65 @@ def analyze_sentences_custom(sentences, api_key, base_url, model, dry_run=False)
 # ==========================
 # 8. 按段落分析 → 写入 jsonl
 # ==========================
-def analyze_file(clean_paragraphs_path, output_jsonl_path, api_key, base_url, model, dry_run=False):
+LLM_MAX_WORKERS = 16
+LLM_CHUNK_SIZE = 50
+
+def _load_paragraphs(path):
+    objs = []
+    with open(path, "rb") as f_in:
+        if os.fstat(f_in.fileno()).st_size == 0:
+            return objs
+        # 整个文件 mmap 进来按行切，字节直接交给 orjson 解析，不经过文本模式逐行解码
+        with mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for line in iter(mm.readline, b""):
+                try:
+                    obj = _loads(line)
+                except Exception:
+                    continue
+                if isinstance(obj, dict):
+                    objs.append(obj)
+    return objs
+
+def _analyze_paragraphs(clean_paragraphs_path, output_jsonl_path, analyze, api_key, base_url, model, dry_run=False):
     outp = Path(output_jsonl_path)
     outp.parent.mkdir(parents=True, exist_ok=True)
-
-    with open(clean_paragraphs_path, "r", encoding="utf-8") as f_in, open(outp, "w", encoding="utf-8") as f_out:
-        for line in f_in:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                obj = json.loads(line)
-            except:
-                continue
-
-            text = str(obj.get("text", ""))
-            sentences = _split_sentences(text)
-            items = analyze_sentences(sentences, api_key, base_url, model, dry_run=dry_run)
-
+    objs = _load_paragraphs(clean_paragraphs_path)
+    sent_lists = [_split_sentences(str(obj.get("text", ""))) for obj in objs]
+
+    # 整个文件的句子先去重（过渡语、口头禅大量重复），每个不同的句子只分析一次，
+    # 按 LLM_CHUNK_SIZE 句一批请求，结果再按原句回填到各段落
+    unique = list(dict.fromkeys(s for sentences in sent_lists for s in sentences))
+    chunks = [unique[i:i + LLM_CHUNK_SIZE] for i in range(0, len(unique), LLM_CHUNK_SIZE)]
+
+    def run(chunk):
+        items = analyze(chunk, api_key, base_url, model, dry_run=dry_run)
+        if len(items) != len(chunk):
+            # 条数对不上就无法按句回填，这一批改用本地规则
+            items = analyze(chunk, api_key, base_url, model, dry_run=True)
+        return items
+
+    # 耗时主要在网络与生成上：线程池并发发出各批请求
+    result = {}
+    with ThreadPoolExecutor(max_workers=LLM_MAX_WORKERS) as ex:
+        for chunk, items in zip(chunks, ex.map(run, chunks)):
+            result.update(zip(chunk, items))
+
+    with open(outp, "wb", buffering=1 << 20) as f_out:
+        for obj, sentences in zip(objs, sent_lists):
             rec = {
                 "video_id": obj.get("video_id"),
                 "paragraph_id": obj.get("paragraph_id"),
                 "start_ms": obj.get("start_ms"),
                 "end_ms": obj.get("end_ms"),
-                "items": items
+                "items": [result[s] for s in sentences]
             }
-            f_out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            f_out.write(_dumps_line(rec))
+
+def analyze_file(clean_paragraphs_path, output_jsonl_path, api_key, base_url, model, dry_run=False):
+    _analyze_paragraphs(clean_paragraphs_path, output_jsonl_path, analyze_sentences, api_key, base_url, model, dry_run)
 
 def analyze_file_custom(clean_paragraphs_path, output_jsonl_path, api_key, base_url, model, dry_run=False):
-    outp = Path(output_jsonl_path)
-    outp.parent.mkdir(parents=True, exist_ok=True)
-    with open(clean_paragraphs_path, "r", encoding="utf-8") as f_in, open(outp, "w", encoding="utf-8") as f_out:
-        for line in f_in:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                obj = json.loads(line)
-            except:
-                continue
-            text = str(obj.get("text", ""))
-            sentences = _split_sentences(text)
-            items = analyze_sentences_custom(sentences, api_key, base_url, model, dry_run=dry_run)
-            rec = {
-                "video_id": obj.get("video_id"),
-                "paragraph_id": obj.get("paragraph_id"),
-                "start_ms": obj.get("start_ms"),
-                "end_ms": obj.get("end_ms"),
-                "items": items
-            }
-            f_out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    _analyze_paragraphs(clean_paragraphs_path, output_jsonl_path, analyze_sentences_custom, api_key, base_url, model, dry_run)
 
 
 
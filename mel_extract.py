@@ -2,55 +2,68 @@
 import argparse
 import json
 import math
+from functools import lru_cache
 import numpy as np
 import soundfile as sf
 from pathlib import Path
 
+try:
+    import scipy.fft as _fft  # pocketfft，多线程按帧并行
+    _FFT_KW = {"workers": -1}
+except Exception:
+    _fft = np.fft
+    _FFT_KW = {}
+
 def hz_to_mel(hz):
     return 2595.0 * math.log10(1.0 + hz / 700.0)
 
 def mel_to_hz(mel):
     return 700.0 * (10.0 ** (mel / 2595.0) - 1.0)
 
+# 滤波器组与窗函数只取决于参数，按参数缓存；返回的数组设为只读，各次调用共享同一份
+@lru_cache(maxsize=16)
 def mel_filterbank(sr, n_fft, n_mels, fmin=0.0, fmax=None):
     if fmax is None:
         fmax = sr / 2.0
     mels = np.linspace(hz_to_mel(fmin), hz_to_mel(fmax), n_mels + 2)
     hz = mel_to_hz(mels)
     bins = np.floor((n_fft + 1) * hz / sr).astype(int)
-    fb = np.zeros((n_mels, n_fft // 2 + 1), dtype=np.float32)
-    for i in range(n_mels):
-        l = bins[i]
-        c = bins[i + 1]
-        r = bins[i + 2]
-        if c > l:
-            fb[i, l:c] = (np.arange(l, c) - l) / (c - l)
-        if r > c:
-            fb[i, c:r] = (r - np.arange(c, r)) / (r - c)
+    # 各滤波器的左/中/右边界一次广播到 (n_mels, n_fft // 2 + 1) 网格上，上升沿与下降沿同时算
+    k = np.arange(n_fft // 2 + 1)
+    l, c, r = bins[:-2, None], bins[1:-1, None], bins[2:, None]
+    up = (k - l) / np.maximum(c - l, 1)
+    down = (r - k) / np.maximum(r - c, 1)
+    fb = np.where((k >= l) & (k < c), up, np.where((k >= c) & (k < r), down, 0.0)).astype(np.float32)
+    fb.flags.writeable = False
     return fb
 
+@lru_cache(maxsize=16)
+def hann_window(win_length):
+    w = np.hanning(win_length).astype(np.float32)
+    w.flags.writeable = False
+    return w
+
 def stft(y, n_fft=400, hop_length=160, win_length=400):
     y = np.asarray(y, dtype=np.float32)
-    w = np.hanning(win_length).astype(np.float32)
-    n_frames = 1 + (len(y) - win_length) // hop_length if len(y) >= win_length else 1
-    frames = np.zeros((n_frames, win_length), dtype=np.float32)
-    for i in range(n_frames):
-        start = i * hop_length
-        end = start + win_length
-        seg = np.zeros(win_length, dtype=np.float32)
-        seg[:max(0, min(win_length, len(y) - start))] = y[start:end]
-        frames[i] = seg * w
-    spec = np.fft.rfft(frames, n=n_fft, axis=1)
+    w = hann_window(win_length)
+    if len(y) < win_length:
+        y = np.pad(y, (0, win_length - len(y)))
+    # 滑窗视图一次取出全部帧（不拷贝），加窗时才生成 (n_frames, win_length) 矩阵
+    frames = np.lib.stride_tricks.sliding_window_view(y, win_length)[::hop_length] * w
+    spec = _fft.rfft(frames, n=n_fft, axis=1, **_FFT_KW)
     return spec
 
 def log_mel_spectrogram(y, sr=16000, n_fft=400, hop_length=160, n_mels=80):
     spec = stft(y, n_fft=n_fft, hop_length=hop_length, win_length=n_fft)
-    power = (spec.real ** 2 + spec.imag ** 2).astype(np.float32)
+    # 复数谱按实数视图原地平方，实部、虚部相加得功率谱，省掉 .real/.imag 两个临时矩阵
+    ri = spec.view(spec.real.dtype)
+    np.square(ri, out=ri)
+    power = np.add(ri[:, 0::2], ri[:, 1::2], dtype=np.float32)
     fb = mel_filterbank(sr, n_fft, n_mels)
-    mel = np.dot(power, fb.T)
-    mel = np.maximum(mel, 1e-10)
-    mel = np.log10(mel)
-    mel = mel.T
+    # fb @ power.T 直接得到 (n_mels, n_frames)，不再额外转置
+    mel = fb @ power.T
+    np.maximum(mel, 1e-10, out=mel)
+    np.log10(mel, out=mel)
     return mel
 
 def pad_or_trim(y, length):
@@ -64,11 +77,16 @@ def pad_or_trim(y, length):
 
 def load_audio(path, sr=16000):
     y, s = sf.read(path, dtype="float32")
-    if s != sr:
-        import resampy
-        y = resampy.resample(y, s, sr)
     if y.ndim > 1:
         y = np.mean(y, axis=1)
+    if s != sr:
+        # 优先用 soxr（SIMD C 实现，HQ 档），缺失时回退 resampy
+        try:
+            import soxr
+            y = soxr.resample(y, s, sr, quality="HQ")
+        except ImportError:
+            import resampy
+            y = resampy.resample(y, s, sr)
     return y
 
 def main():
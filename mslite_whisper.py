@@ -1,14 +1,43 @@
 #!/usr/bin/env python3
+import hashlib
 import os
 import sys
+import tempfile
 from pathlib import Path
 import numpy as np
 import json
 
+try:
+    import scipy.fft as _fft  # pocketfft，多线程按帧并行
+    _FFT_KW = {"workers": -1}
+except Exception:
+    _fft = np.fft
+    _FFT_KW = {}
+
+def log_mel(y, fb, win, n_fft, hop):
+    """纯数值函数：补齐后的 16k 音频 -> (n_mels, frames) 的 log10 mel 谱，不依赖实例状态"""
+    # 滑窗视图一次取出全部帧，加窗广播生成 (frames, n_fft) 矩阵
+    X = np.lib.stride_tricks.sliding_window_view(y, n_fft)[::hop] * win
+    spec = _fft.rfft(X, n=n_fft, axis=1, **_FFT_KW)
+    # 复数谱按实数视图原地平方，相邻的实部、虚部相加得功率谱，不再生成 .real/.imag 两个临时矩阵
+    ri = spec.view(spec.real.dtype)
+    np.square(ri, out=ri)
+    power = np.add(ri[:, 0::2], ri[:, 1::2], dtype=np.float32)
+    # 滤波器组在左侧直接得到 (n_mels, frames)，省掉末尾转置；截断与取对数都原地进行
+    mel = fb @ power.T
+    np.maximum(mel, 1e-10, out=mel)
+    np.log10(mel, out=mel)
+    return mel
+
 class LiteWhisperASR:
-    def __init__(self, model_size, device, compute_type):
+    def __init__(self, model_size, device, compute_type, cache_mel=None):
         self.device = device
         self.compute_type = compute_type
+        # 按文件缓存 mel 特征（models/mslite/<size>/cache），重复跑同一批音频时跳过特征提取；
+        # 未显式指定时看环境变量 SAGEAGENT_MEL_CACHE=on
+        if cache_mel is None:
+            cache_mel = os.environ.get("SAGEAGENT_MEL_CACHE", "").lower() in ("on", "1", "true")
+        self.cache_mel = cache_mel
         try:
             import mindspore_lite as msl
             self.msl = msl
@@ -49,6 +78,67 @@ class LiteWhisperASR:
         self.eos_id = 50257
         self.max_len = 128
         self.beam_size = 3
+        self.prune_topk = 50
+        self.tok = self._load_tokenizer()
+        self._prompts = {}
+        self._enc_dtype = self._input_dtype(self.enc, 0)
+        self._dtype = self._input_dtype(self.dec_init, 1)
+        self._init_features()
+
+    def _load_tokenizer(self):
+        # 分词器只在构造时加载一次（读词表/merges 很慢）；都不可用时为 None，转写结果为空文本
+        try:
+            from transformers import WhisperTokenizer
+            return WhisperTokenizer.from_pretrained("openai/whisper-tiny")
+        except Exception:
+            pass
+        try:
+            from whisper.tokenizer import get_tokenizer
+            return get_tokenizer(multilingual=True)
+        except Exception:
+            return None
+
+    def _init_features(self):
+        # 窗函数与 mel 滤波器组只取决于固定参数，构造时算一次，每次转写直接复用
+        self.n_fft = 400
+        self.hop = 160
+        self.n_mels = 80
+        n_fft, n_mels = self.n_fft, self.n_mels
+        self._win = np.hanning(n_fft).astype(np.float32)
+        # 滤波器组预先存成 mel_filters.npy 与模型放在一起，按内存映射加载，多进程共享页缓存；
+        # 文件缺失或形状不符时现算并尝试写回（npz 不支持 mmap，故用 npy）；
+        # 与 mel 缓存一样先写唯一临时文件再 os.replace，多个进程同时启动也不会互相覆盖或读到半截文件
+        fb_path = self.root / "mel_filters.npy"
+        try:
+            fb = np.load(fb_path, mmap_mode="r")
+            if fb.shape != (n_mels, n_fft // 2 + 1) or fb.dtype != np.float32:
+                raise ValueError("mel_filters shape mismatch")
+        except Exception:
+            fb = self._mel_filterbank(n_fft, n_mels)
+            try:
+                with tempfile.NamedTemporaryFile(dir=fb_path.parent, suffix=".npy", delete=False) as tmp:
+                    np.save(tmp, fb)
+                os.replace(tmp.name, fb_path)
+            except Exception:
+                pass
+        self._fb = fb
+
+    @staticmethod
+    def _mel_filterbank(n_fft, n_mels):
+        def hz_to_mel(hz):
+            return 2595.0 * np.log10(1.0 + hz / 700.0)
+        def mel_to_hz(mel):
+            return 700.0 * (10.0 ** (mel / 2595.0) - 1.0)
+        mels = np.linspace(hz_to_mel(0.0), hz_to_mel(8000.0), n_mels + 2)
+        hz = mel_to_hz(mels)
+        bins = np.floor((n_fft + 1) * hz / 16000.0).astype(int)
+        # 所有三角滤波器在 (n_mels, n_fft // 2 + 1) 网格上一次广播算出上升沿与下降沿
+        k = np.arange(n_fft // 2 + 1)
+        l, c, r = bins[:-2, None], bins[1:-1, None], bins[2:, None]
+        up = (k - l) / np.maximum(c - l, 1)
+        down = (r - k) / np.maximum(r - c, 1)
+        fb = np.where((k >= l) & (k < c), up, np.where((k >= c) & (k < r), down, 0.0))
+        return fb.astype(np.float32)
 
     def _context(self):
         ctx = self.msl.Context()
@@ -56,71 +146,85 @@ class LiteWhisperASR:
             ctx.target = ["gpu"] if self.device == "cuda" else ["cpu"]
         except Exception:
             ctx.target = ["cpu"]
+        if self.compute_type == "float16":
+            # 让算子优先走 fp16 内核：带宽减半，支持 fp16 的 CPU/GPU 上吞吐约翻倍
+            try:
+                if self.device == "cuda":
+                    ctx.gpu.precision_mode = "preferred_fp16"
+                else:
+                    ctx.cpu.precision_mode = "preferred_fp16"
+            except Exception:
+                pass
         return ctx
 
-    def _load_audio(self, path):
+    def _input_dtype(self, model, idx):
+        """compute_type 为 float16 且模型该输入本身是 fp16（转换时已量化）时按 fp16 喂数据，否则 float32"""
+        if self.compute_type != "float16":
+            return np.float32
+        try:
+            if model.get_inputs()[idx].dtype == self.msl.DataType.FLOAT16:
+                return np.float16
+        except Exception:
+            pass
+        return np.float32
+
+    def _load_audio(self, audio):
         import numpy as np
-        from scipy.io import wavfile
-        sr, y = wavfile.read(path)
+        if isinstance(audio, np.ndarray):
+            # build_dataset 经 ffmpeg 管道直接传入 16k float32 数组
+            sr, y = 16000, audio
+        else:
+            from scipy.io import wavfile
+            sr, y = wavfile.read(audio)
         if y.ndim > 1:
             y = y.mean(axis=1)
         y = y.astype(np.float32) / (np.iinfo(y.dtype).max if y.dtype != np.float32 else 1.0)
         # pad or trim to 30s
         target = 16000 * 30
         if sr != 16000:
-            # assume input is 16k since we extract with ffmpeg; if not, simple resample ratio
-            import math
-            ratio = 16000 / float(sr)
-            idx = (np.arange(int(len(y) * ratio)) / ratio).astype(np.int64)
-            idx = np.minimum(idx, len(y) - 1)
-            y = y[idx]
+            # ffmpeg 抽出的音频已是 16k；其他采样率用多相 FIR 重采样，比最近邻取样保真且一次 C 调用完成
+            from math import gcd
+            from scipy.signal import resample_poly
+            g = gcd(sr, 16000)
+            y = resample_poly(y, 16000 // g, sr // g).astype(np.float32)
         if len(y) > target:
             y = y[:target]
         elif len(y) < target:
             pad = np.zeros(target, dtype=np.float32)
             pad[:len(y)] = y
             y = pad
-        # compute log-mel
-        n_fft = 400
-        hop = 160
-        win = np.hanning(n_fft).astype(np.float32)
-        frames = 1 + (len(y) - n_fft) // hop if len(y) >= n_fft else 1
-        X = np.zeros((frames, n_fft), dtype=np.float32)
-        for i in range(frames):
-            s = i * hop
-            e = s + n_fft
-            seg = np.zeros(n_fft, dtype=np.float32)
-            seg[:max(0, min(n_fft, len(y) - s))] = y[s:e]
-            X[i] = seg * win
-        spec = np.fft.rfft(X, n=n_fft, axis=1)
-        power = (spec.real ** 2 + spec.imag ** 2).astype(np.float32)
-        # mel filterbank
-        def hz_to_mel(hz):
-            return 2595.0 * np.log10(1.0 + hz / 700.0)
-        def mel_to_hz(mel):
-            return 700.0 * (10.0 ** (mel / 2595.0) - 1.0)
-        n_mels = 80
-        mels = np.linspace(hz_to_mel(0.0), hz_to_mel(8000.0), n_mels + 2)
-        hz = mel_to_hz(mels)
-        bins = np.floor((n_fft + 1) * hz / 16000.0).astype(int)
-        fb = np.zeros((n_mels, n_fft // 2 + 1), dtype=np.float32)
-        for i in range(n_mels):
-            l = bins[i]; c = bins[i+1]; r = bins[i+2]
-            if c > l:
-                fb[i, l:c] = (np.arange(l, c) - l) / (c - l)
-            if r > c:
-                fb[i, c:r] = (r - np.arange(c, r)) / (r - c)
-        mel = np.dot(power, fb.T)
-        mel = np.maximum(mel, 1e-10)
-        mel = np.log10(mel).T
-        return mel
+        return log_mel(y, self._fb, self._win, self.n_fft, self.hop)
+
+    def _mel_cache_path(self, audio):
+        try:
+            st = os.stat(audio)
+        except OSError:
+            return None
+        parts = (os.path.abspath(str(audio)), st.st_mtime_ns, st.st_size, self.n_mels, self.n_fft, self.hop, 16000)
+        key = hashlib.sha256("\0".join(map(str, parts)).encode("utf-8")).hexdigest()
+        return self.root / "cache" / f"{key}.npy"
 
-    def _softmax(self, x):
-        x = x.astype(np.float32)
-        x = x - np.max(x)
-        e = np.exp(x)
-        s = np.sum(e)
-        return e / (s + 1e-6)
+    def _mel(self, audio):
+        """mel 特征：开启缓存且输入为文件路径时优先内存映射读取缓存，未命中则计算后写入"""
+        if not self.cache_mel or isinstance(audio, np.ndarray):
+            return self._load_audio(audio)
+        path = self._mel_cache_path(audio)
+        if path is None:
+            return self._load_audio(audio)
+        try:
+            return np.load(path, mmap_mode="r")
+        except Exception:
+            pass
+        mel = self._load_audio(audio)
+        # 先写临时文件再 os.replace，并发或中途退出都不会留下半截缓存
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=path.parent, suffix=".npy", delete=False) as tmp:
+                np.save(tmp, mel)
+            os.replace(tmp.name, path)
+        except OSError:
+            pass
+        return mel
 
     def _topk(self, probs, k):
         idx = np.argpartition(-probs, k)[:k]
@@ -128,77 +232,135 @@ class LiteWhisperASR:
         order = np.argsort(-vals)
         return idx[order], vals[order]
 
+    def _decode_step(self, ein, seq, past=None):
+        """
+        对 (B, L) 的一批序列解码一步，返回各序列最后一个位置的 logits (B, V) 与供下一步使用的 past。
+        有 decoder_with_past 且上一步拿到了 past（解码器除 logits 外还输出各层 K/V）时，
+        只喂最新 token：输入为 [input_ids, encoder_hidden_states, *past]，输出为 [logits, *present]，
+        每步计算量与已生成长度无关；否则退回把整个前缀交给 decoder_init 重算
+        """
+        dec_out = []
+        if past is not None:
+            self.dec_past.predict([self.msl.Tensor(np.ascontiguousarray(seq[:, -1:])), ein, *past], dec_out)
+        else:
+            self.dec_init.predict([self.msl.Tensor(seq), ein], dec_out)
+        logits = dec_out[0].get_data_to_numpy()
+        nxt = dec_out[1:] if self.dec_past is not None and len(dec_out) > 1 else None
+        return logits[:, -1], nxt
+
     def _greedy_decode(self, enc_hidden, ids):
-        ein = self.msl.Tensor(enc_hidden.astype(np.float32))
+        ein = self.msl.Tensor(enc_hidden.astype(self._dtype))
+        # 输出缓冲按最大长度一次分配，逐步写入新 token，不再每步拼接出新数组
+        n = ids.shape[1]
+        out = np.zeros((1, n + self.max_len), dtype=np.int32)
+        out[:, :n] = ids
+        past = None
         for _ in range(self.max_len):
-            din = self.msl.Tensor(ids)
-            dec_out = []
-            self.dec_init.predict([din, ein], dec_out)
-            logits = dec_out[0].get_data_to_numpy()
-            next_id = int(logits[0, ids.shape[1]-1].argmax())
-            ids = np.concatenate([ids, np.array([[next_id]], dtype=np.int32)], axis=1)
+            last, past = self._decode_step(ein, out[:, :n], past)
+            next_id = int(last[0].argmax())
+            out[0, n] = next_id
+            n += 1
             if next_id == self.eos_id:
                 break
-        return ids
+        return out[:, :n]
 
     def _beam_decode(self, enc_hidden, ids, beam_size):
-        ein = self.msl.Tensor(enc_hidden.astype(np.float32))
-        beams = [(ids, 0.0, False)]
+        enc_hidden = enc_hidden.astype(self._dtype)
+        eins = {}
+        # 各假设的 token 存在预分配的 (beam, 最大长度) 缓冲里，每步按父行号整体重排一次再写入新 token
+        buf = np.zeros((1, ids.shape[1] + self.max_len), dtype=np.int32)
+        buf[0, :ids.shape[1]] = ids[0]
+        # (缓冲行号, 长度, 累计对数概率, 是否结束, 父序列在上一步批次中的行号)
+        beams = [(0, ids.shape[1], 0.0, False, 0)]
+        present = None
         for _ in range(self.max_len):
-            new_beams = []
-            all_finished = True
-            for seq, score, finished in beams:
+            # 未结束的假设长度相同，拼成 (B, L) 一批，每步只调用一次解码器；编码输出按 B 复制一次后缓存
+            open_beams = [b for b in beams if not b[3]]
+            n = len(open_beams)
+            if n not in eins:
+                eins[n] = self.msl.Tensor(np.repeat(enc_hidden, n, axis=0))
+            seqs = buf[[b[0] for b in open_beams], :open_beams[0][1]]
+            past = None
+            if present is not None:
+                # 按父序列行号重排上一步输出的 K/V
+                rows = [b[4] for b in open_beams]
+                past = [self.msl.Tensor(np.ascontiguousarray(p.get_data_to_numpy()[rows])) for p in present]
+            lasts, present = self._decode_step(eins[n], seqs, past)
+            # 候选：(来源缓冲行号, 长度, 累计对数概率, 是否结束, 批次行号, 新 token)
+            cands = []
+            row = 0
+            for brow, length, score, finished, _ in beams:
                 if finished:
-                    new_beams.append((seq, score, True))
+                    cands.append((brow, length, score, True, 0, None))
                     continue
-                din = self.msl.Tensor(seq)
-                dec_out = []
-                self.dec_init.predict([din, ein], dec_out)
-                logits = dec_out[0].get_data_to_numpy()
-                last = logits[0, seq.shape[1]-1]
-                probs = self._softmax(last)
-                idxs, vals = self._topk(probs, beam_size)
-                for nid, pv in zip(idxs, vals):
-                    nseq = np.concatenate([seq, np.array([[int(nid)]], dtype=np.int32)], axis=1)
-                    nfin = int(nid) == self.eos_id
-                    new_beams.append((nseq, score + float(np.log(pv + 1e-8)), nfin))
-                    if not nfin:
-                        all_finished = False
-            new_beams.sort(key=lambda x: x[1], reverse=True)
-            beams = new_beams[:beam_size]
-            if all_finished:
+                last = lasts[row].astype(np.float32)
+                # 归一化仍要对整个词表做一次 exp 求和（logits - logsumexp），各假设之间及与已结束假设的分数才可比；
+                # 剪枝省下的只是整表概率数组的除法/取对数，以及排序只在 prune_topk 个候选里做
+                k = min(self.prune_topk, last.shape[0])
+                cand = np.argpartition(-last, k - 1)[:k]
+                m = last.max()
+                logp = last[cand] - (m + np.log(np.exp(last - m).sum()))
+                idxs, vals = self._topk(logp, min(beam_size, k - 1))
+                for nid, lp in zip(cand[idxs], vals):
+                    nid = int(nid)
+                    cands.append((brow, length + 1, score + float(lp), nid == self.eos_id, row, nid))
+                row += 1
+            cands.sort(key=lambda x: x[2], reverse=True)
+            cands = cands[:beam_size]
+            buf = buf[[c[0] for c in cands]]
+            beams = []
+            for i, (_, length, score, finished, prow, nid) in enumerate(cands):
+                if nid is not None:
+                    buf[i, length - 1] = nid
+                beams.append((i, length, score, finished, prow))
+            # 累计对数概率只会越来越小：全部结束，或已结束的最优假设不低于所有未结束假设时，结果不会再变
+            best_fin = max((b[2] for b in beams if b[3]), default=None)
+            best_open = max((b[2] for b in beams if not b[3]), default=None)
+            if best_fin is not None and (best_open is None or best_fin >= best_open):
                 break
-        return beams[0][0]
+        brow, length = beams[0][0], beams[0][1]
+        return buf[brow:brow + 1, :length]
+
+    def _prompt_ids(self, language, task):
+        # 解码提示只取决于 (language, task)，查一次分词器后缓存，批量转写短音频时不再反复查词表
+        key = (language, task)
+        prompt = self._prompts.get(key)
+        if prompt is None:
+            if self.processor is not None:
+                prompt = np.array([self.processor.get_decoder_prompt_ids(language=language, task=task)], dtype=np.int32)
+            else:
+                prompt = np.array([[50258, 50259]], dtype=np.int32)
+            self._prompts[key] = prompt
+        return prompt
 
-    def transcribe(self, audio_path, language="zh", mode="greedy", beam_size=3):
-        mel = self._load_audio(audio_path)
-        enc_in = self.msl.Tensor(mel.astype(np.float32))
+    def transcribe(self, audio, language="zh", mode="greedy", beam_size=3):
+        return self.transcribe_batch([audio], language=language, mode=mode, beam_size=beam_size)[0]
+
+    def transcribe_batch(self, audios, language="zh", mode="greedy", beam_size=3):
+        """
+        多个 30s 窗口的 mel 叠成 (B, 80, 3000) 一次送编码器（导出时 batch 维是动态轴），
+        再逐条解码；返回与 audios 对应的片段列表
+        """
+        mels = np.stack([self._mel(a) for a in audios])
+        enc_in = self.msl.Tensor(mels.astype(self._enc_dtype))
         enc_out = []
         self.enc.predict([enc_in], enc_out)
         enc_hidden = enc_out[0].get_data_to_numpy()
-        prompt = None
-        if self.processor is not None:
-            prompt = np.array([self.processor.get_decoder_prompt_ids(language=language, task="transcribe")], dtype=np.int32)
-        else:
-            prompt = np.array([[50258, 50259]], dtype=np.int32)
-        if mode == "beam":
-            ids = self._beam_decode(enc_hidden, prompt, beam_size)
-        else:
-            ids = self._greedy_decode(enc_hidden, prompt)
-        text = ""
-        try:
-            from transformers import WhisperTokenizer
-            tok = WhisperTokenizer.from_pretrained("openai/whisper-tiny")
-            text = tok.decode(ids[0])
-        except Exception:
-            try:
-                import whisper
-                from whisper.tokenizer import get_tokenizer
-                tok2 = get_tokenizer(multilingual=True)
-                text = tok2.decode(list(map(int, ids[0])))
-            except Exception:
-                pass
-        return [{"segment_id": "00000", "start_ms": 0, "end_ms": int(30*1000), "text": text}]
+        prompt = self._prompt_ids(language, "transcribe")
+        results = []
+        for i in range(len(audios)):
+            if mode == "beam":
+                ids = self._beam_decode(enc_hidden[i:i + 1], prompt, beam_size)
+            else:
+                ids = self._greedy_decode(enc_hidden[i:i + 1], prompt)
+            text = ""
+            if self.tok is not None:
+                try:
+                    text = self.tok.decode(list(map(int, ids[0])))
+                except Exception:
+                    pass
+            results.append([{"segment_id": "00000", "start_ms": 0, "end_ms": int(30*1000), "text": text}])
+        return results
 
 def export_mindir(model_size, out_dir):
     out = Path(out_dir)
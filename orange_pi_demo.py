@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import argparse
 import time
+from bisect import bisect_right
 import json
 import numpy as np
 from pathlib import Path
@@ -11,13 +12,17 @@ except Exception:
     cv2 = None
 
 def overlay_subtitle(frame, text):
-    if cv2 is None:
+    """
+    在帧底部画半透明黑底字幕，原地修改 frame：
+    黑色矩形按 0.5 混合等价于只把矩形区域亮度减半，不必整帧复制再整帧混合；无字幕时不画底框
+    """
+    if cv2 is None or not text:
         return frame
     h, w = frame.shape[:2]
-    overlay = frame.copy()
-    cv2.rectangle(overlay, (10, h-80), (w-10, h-10), (0, 0, 0), -1)
+    # cv2.rectangle 填充时包含两端点，对应切片上界 +1
+    roi = frame[h-80:h-9, 10:w-9]
     alpha = 0.5
-    frame = cv2.addWeighted(overlay, alpha, frame, 1 - alpha, 0)
+    np.multiply(roi, 1 - alpha, out=roi, casting="unsafe")
     cv2.putText(frame, text[:80], (20, h-30), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
     return frame
 
@@ -38,19 +43,19 @@ def main():
                 subs.append(obj)
             except Exception:
                 continue
-    i = 0
+    # 字幕按开始时间排好，字段提前拆成列表：每帧二分查找开始时间不晚于当前时刻的最后一条
+    subs.sort(key=lambda x: x.get("start_ms", 0))
+    starts = [x.get("start_ms", 0) for x in subs]
+    ends = [x.get("end_ms", 0) for x in subs]
+    texts = [x.get("text", "") for x in subs]
     start = time.time()
     while True:
         ok, frame = cap.read()
         if not ok:
             break
         t_ms = int((time.time() - start) * 1000)
-        text = ""
-        while i < len(subs) and subs[i].get("start_ms", 0) <= t_ms:
-            if subs[i].get("end_ms", 0) >= t_ms:
-                text = subs[i].get("text", "")
-                break
-            i += 1
+        idx = bisect_right(starts, t_ms) - 1
+        text = texts[idx] if idx >= 0 and ends[idx] >= t_ms else ""
         frame = overlay_subtitle(frame, text)
         cv2.imshow("OrangePi Subtitle Demo", frame)
         if cv2.waitKey(1) & 0xFF == ord('q'):
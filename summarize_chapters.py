@@ -5,41 +5,54 @@ import re
 from pathlib import Path
 
 def load_chapters(path):
-    chs = []
+    """逐行产出章节（生成器），调用方边读边写，不在内存里攒整个文件"""
     with open(path, "r", encoding="utf-8") as f:
-        for line in f:
-            try:
-                obj = json.loads(line)
-                if all(k in obj for k in ("chapter_id", "title", "items")):
-                    chs.append(obj)
-            except Exception:
-                continue
-    return chs
+        yield from iter_chapters(f)
+
+def iter_chapters(f):
+    for line in f:
+        try:
+            obj = json.loads(line)
+        except Exception:
+            continue
+        if all(k in obj for k in ("chapter_id", "title", "items")):
+            yield obj
 
 def collapse_text(items, max_len=2000):
     buf = []
+    total = 0
     for it in items:
         t = str(it.get("text", "")).strip()
         if t:
             buf.append(t)
-        if sum(len(x) for x in buf) >= max_len:
+            total += len(t)
+        if total >= max_len:
             break
     return "。".join(buf)
 
+# 主题触发词合成一个交替模式，标题+正文只扫描一遍，命中的触发词映射到主题
+_TOPIC_RE = re.compile(r"单调性|原函数|导函数|周期")
+_TOPIC_OF = {"单调性": "mono", "原函数": "deriv", "导函数": "deriv", "周期": "period"}
+_POS_DERIV_RE = re.compile(r"导数大于0|d\s*f\s*>\s*0")
+_DERIV_RE = re.compile(r"原函数|导函数")
+_CONST_RE = re.compile(r"常数|无数个|加上任意常数")
+_SENT_SPLIT_RE = re.compile(r"[。！？]\s*")
+
 def rule_summary(title, text, style="exam"):
     pts = []
-    if re.search(r"单调性", title + text):
-        if re.search(r"导数大于0|d\s*f\s*>\s*0", text):
+    topics = {_TOPIC_OF[m] for m in _TOPIC_RE.findall(title + text)}
+    if "mono" in topics:
+        if _POS_DERIV_RE.search(text):
             pts.append("导数>0 ⇒ 函数单调增，导数<0 ⇒ 函数单调减")
-        if re.search(r"原函数|导函数", text):
+        if _DERIV_RE.search(text):
             pts.append("原函数与导函数奇偶关系：原奇⇒导偶，原偶⇒导奇")
-    if re.search(r"原函数|导函数", title + text):
-        if re.search(r"常数|无数个|加上任意常数", text):
+    if "deriv" in topics:
+        if _CONST_RE.search(text):
             pts.append("已知导函数，原函数可加常数形成无穷多解")
-    if re.search(r"周期", title + text):
+    if "period" in topics:
         pts.append("周期结论相互推出需满足同时条件，不可单边推出")
     if not pts:
-        sents = re.split(r"[。！？]\s*", text)
+        sents = _SENT_SPLIT_RE.split(text)
         pts = [s for s in sents if s][:5]
     brief = title if title else "本章内容"
     if style == "exam":
@@ -47,17 +60,17 @@ def rule_summary(title, text, style="exam"):
         question_patterns = []
         pitfalls = []
         tips = []
-        if re.search(r"单调性", title + text):
+        if "mono" in topics:
             exam_points.append("导数符号与单调性的对应关系")
             question_patterns.append("给定导数符号判断单调增减")
             pitfalls.append("忽略导数符号，仅凭\"单调\"字样下结论")
             tips.append("先判定导数范围与符号，再下结论")
-        if re.search(r"原函数|导函数", title + text):
+        if "deriv" in topics:
             exam_points.append("原与导的奇偶关系与可加常数性质")
             question_patterns.append("已知小f判断大F奇偶；已知大F判断小f奇偶")
             pitfalls.append("奇函数加常数不再为奇；偶函数加常数仍为偶")
             tips.append("记忆：原奇⇒导偶，原偶⇒导奇；已知导函数，原函数可加常数")
-        if re.search(r"周期", title + text):
+        if "period" in topics:
             exam_points.append("周期性质的相互推出条件")
             question_patterns.append("仅给一侧周期试图推出另一侧周期")
             pitfalls.append("缺少同时条件仍做推出")
@@ -159,22 +172,35 @@ def create_app():
         style: str = "exam"
     @app.post("/summarize")
     def summarize(req: Req):
-        chs = load_chapters(req.file)
-        out = []
-        for c in chs:
-            text = collapse_text(c.get("items", []), max_len=3000)
-            summ = rule_summary(c.get("title", ""), text, style=req.style)
-            out.append({
-                "chapter_id": c.get("chapter_id"),
-                "title": c.get("title"),
-                "summary_title": summ["title"],
-                "bullets": summ["bullets"],
-                "exam_points": summ.get("exam_points", []),
-                "question_patterns": summ.get("question_patterns", []),
-                "pitfalls": summ.get("pitfalls", []),
-                "tips": summ.get("tips", []),
-            })
-        return {"summaries": out}
+        from fastapi import HTTPException
+        from fastapi.responses import StreamingResponse
+
+        # 先打开文件再开始响应：文件不存在或不可读时返回错误状态码，而不是在 200 之后输出半截 JSON
+        try:
+            f = open(req.file, "r", encoding="utf-8")
+        except OSError as e:
+            raise HTTPException(status_code=404 if isinstance(e, FileNotFoundError) else 400, detail=f"cannot open file: {e.strerror}")
+
+        # 仍返回 {"summaries": [...]}，但逐章生成、逐章输出，不先把所有章节读进内存
+        def gen():
+            with f:
+                yield '{"summaries": ['
+                for i, c in enumerate(iter_chapters(f)):
+                    text = collapse_text(c.get("items", []), max_len=3000)
+                    summ = rule_summary(c.get("title", ""), text, style=req.style)
+                    rec = {
+                        "chapter_id": c.get("chapter_id"),
+                        "title": c.get("title"),
+                        "summary_title": summ["title"],
+                        "bullets": summ["bullets"],
+                        "exam_points": summ.get("exam_points", []),
+                        "question_patterns": summ.get("question_patterns", []),
+                        "pitfalls": summ.get("pitfalls", []),
+                        "tips": summ.get("tips", []),
+                    }
+                    yield ("," if i else "") + json.dumps(rec, ensure_ascii=False)
+                yield "]}"
+        return StreamingResponse(gen(), media_type="application/json")
     return app
 
 def main():
@@ -194,14 +220,13 @@ def main():
         app = create_app()
         uvicorn.run(app, host="0.0.0.0", port=8000)
         return
-    chs = load_chapters(args.input)
-    write_summaries(chs, args.output, style=args.style)
+    write_summaries(load_chapters(args.input), args.output, style=args.style)
     
     # 可选生成文本格式
     if args.text_format:
         # 将输出文件路径的.jsonl替换为_text.txt
         text_path = str(Path(args.output).with_suffix('')) + "_text.txt"
-        write_summaries_text(chs, text_path, style=args.style)
+        write_summaries_text(load_chapters(args.input), text_path, style=args.style)
         print("✅ 文本格式文件已生成")
 
 if __name__ == "__main__":
@@ -2,37 +2,73 @@
 import argparse
 import json
 import math
+import multiprocessing
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+_loads = orjson.loads if orjson is not None else json.loads
+
+def _dumps_line(rec):
+    if orjson is not None:
+        return orjson.dumps(rec) + b"\n"
+    return (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+
+WRITE_CHUNK = 4096
+
+_SEGMENT_KEYS = {"video_id", "start_ms", "end_ms", "src"}
+_CHAPTER_KEYS = {"chapter_id", "title", "items"}
+
 def load_segments(path):
     segs = []
-    with open(path, "r", encoding="utf-8") as f:
+    # 二进制逐行读，字节直接交给 orjson 解析，省去文本模式的逐行解码
+    with open(path, "rb") as f:
         for line in f:
             try:
-                obj = json.loads(line)
-                if all(k in obj for k in ("video_id", "start_ms", "end_ms", "src")):
+                obj = _loads(line)
+                if obj.keys() >= _SEGMENT_KEYS:
+                    # 加载时一次性规整类型，micro_summaries 的热循环直接按键取值
+                    obj["start_ms"] = int(obj["start_ms"])
+                    obj["end_ms"] = int(obj["end_ms"])
+                    obj["src"] = str(obj["src"])
                     segs.append(obj)
             except Exception:
                 continue
-    segs.sort(key=lambda x: (x.get("video_id"), int(x.get("start_ms", 0))))
+    # 单个视频的 ASR 输出本来就按时间有序：线性检查一遍，已有序就不再排序
+    keys = [(x["video_id"], x["start_ms"]) for x in segs]
+    if any(a > b for a, b in zip(keys, keys[1:])):
+        segs.sort(key=lambda x: (x["video_id"], x["start_ms"]))
     return segs
 
 def load_chapters(path):
     chs = []
-    with open(path, "r", encoding="utf-8") as f:
+    with open(path, "rb") as f:
         for line in f:
             try:
-                obj = json.loads(line)
-                if all(k in obj for k in ("chapter_id", "title", "items")):
+                obj = _loads(line)
+                if obj.keys() >= _CHAPTER_KEYS:
                     chs.append(obj)
             except Exception:
                 continue
     return chs
 
+_WS_RE = re.compile(r"\s+")
+_SENT_RE = re.compile(r"[。！？]\s*")
+
+# 既无空白也无句末标点时，规整与分句都不会改动文本
+_NEEDS_SPLIT_RE = re.compile(r"[\s。！？]")
+
 def simple_summarize(text, max_len=120):
-    text = re.sub(r"\s+", " ", text).strip()
-    sents = re.split(r"[。！？]\s*", text)
+    if len(text) <= max_len and not _NEEDS_SPLIT_RE.search(text):
+        return text
+    text = _WS_RE.sub(" ", text).strip()
+    sents = _SENT_RE.split(text)
     sents = [s for s in sents if s]
     if not sents:
         return text[:max_len]
@@ -41,71 +77,90 @@ def simple_summarize(text, max_len=120):
         key = sents[0] + "，" + sents[1]
     return (key[:max_len] + ("…" if len(key) > max_len else ""))
 
+# 各触发词合成一个交替模式，正文只扫描一遍；命中的分组记入位掩码，所有分组都命中即提前结束
+# （触发词互不重叠，finditer 的结果与逐个 search 一致）
+_EXAM_RE = re.compile(r"(?P<deriv>导数)|(?P<mono>单调)|(?P<parity>原函数|导函数|奇偶)|(?P<period>周期)|(?P<odd>奇函数加常数)")
+_EXAM_BIT = {"deriv": 1, "mono": 2, "parity": 4, "period": 8, "odd": 16}
+_EXAM_ALL = 31
+_EXAM_TRIGGERS = ("导数", "单调", "原函数", "导函数", "奇偶", "周期", "奇函数加常数")
+
+def exam_flags(text):
+    """返回命中的触发词分组位掩码；大多数窗口一个触发词都没有，先用子串查找（C 层快速搜索）排除，不进正则"""
+    if not any(t in text for t in _EXAM_TRIGGERS):
+        return 0
+    flags = 0
+    for m in _EXAM_RE.finditer(text):
+        flags |= _EXAM_BIT[m.lastgroup]
+        if flags == _EXAM_ALL:
+            break
+    return flags
+
 def exam_extract(text):
+    flags = exam_flags(text)
     points = []
-    if re.search(r"导数|单调", text):
+    if flags & 3:
         points.append("导数符号与单调性的对应关系")
-    if re.search(r"原函数|导函数|奇偶", text):
+    if flags & 4:
         points.append("原/导奇偶关系与原函数可加常数")
-    if re.search(r"周期", text):
+    if flags & 8:
         points.append("周期性质相互推出需同时条件")
     pitfalls = []
-    if re.search(r"奇函数加常数", text):
+    if flags & 16:
         pitfalls.append("奇函数加常数不再为奇；偶函数加常数仍为偶")
     tips = []
-    if re.search(r"导数", text):
+    if flags & 1:
         tips.append("先判定导数范围与符号，再下单调结论")
     return points, pitfalls, tips
 
+# 窗口数达到该值才分发到进程池；窗口少时起进程与序列化的开销比摘要本身还大
+MICRO_PARALLEL_MIN = 256
+
+def _summarize_window(window):
+    start, end, text, exam = window
+    rec = {
+        "start_ms": start,
+        "end_ms": end,
+        "summary": simple_summarize(text, 60)
+    }
+    if exam:
+        pts, pits, tips = exam_extract(text)
+        rec["exam_points"] = pts
+        rec["pitfalls"] = pits
+        rec["tips"] = tips
+    return rec
+
 def micro_summaries(segs, window_sec=60, exam=False):
-    out = []
+    # 先单遍切出各时间窗的 (起, 止, 文本)，不做正则；各窗口互相独立，再统一摘要
+    windows = []
     cur_start = None
     cur_end = None
     buf = []
     for s in segs:
-        start = int(s.get("start_ms", 0))
-        end = int(s.get("end_ms", 0))
+        start = s["start_ms"]
+        end = s["end_ms"]
         if cur_start is None:
             cur_start = start
             cur_end = start + window_sec*1000
         if end <= cur_end:
-            buf.append(str(s.get("src", "")))
+            buf.append(s["src"])
         else:
-            text = "。".join(buf)
-            rec = {
-                "start_ms": cur_start,
-                "end_ms": cur_end,
-                "summary": simple_summarize(text, 60)
-            }
-            if exam:
-                pts, pits, tips = exam_extract(text)
-                rec["exam_points"] = pts
-                rec["pitfalls"] = pits
-                rec["tips"] = tips
-            out.append(rec)
-            buf = [str(s.get("src", ""))]
+            windows.append((cur_start, cur_end, "。".join(buf), exam))
+            buf = [s["src"]]
             cur_start = cur_end
             cur_end = cur_start + window_sec*1000
     if buf:
-        text = "。".join(buf)
-        rec = {
-            "start_ms": cur_start,
-            "end_ms": cur_end,
-            "summary": simple_summarize(text, 60)
-        }
-        if exam:
-            pts, pits, tips = exam_extract(text)
-            rec["exam_points"] = pts
-            rec["pitfalls"] = pits
-            rec["tips"] = tips
-        out.append(rec)
-    return out
+        windows.append((cur_start, cur_end, "。".join(buf), exam))
+    if len(windows) < MICRO_PARALLEL_MIN:
+        return [_summarize_window(w) for w in windows]
+    # 与 clean_text 一样用 spawn 起子进程：web_app 会在后台任务线程里调用，fork 不安全
+    with multiprocessing.get_context("spawn").Pool(os.cpu_count() or 1) as pool:
+        return pool.map(_summarize_window, windows, chunksize=16)
 
 def chapter_summaries(chs):
     out = []
     for c in chs:
         items = c.get("items", [])
-        text = "。".join([str(it.get("text", "")) for it in items])
+        text = "。".join(str(it.get("text", "")) for it in items)
         one_line = simple_summarize(text, 80)
         one_paragraph = simple_summarize(text, 240)
         out.append({
@@ -117,13 +172,8 @@ def chapter_summaries(chs):
     return out
 
 def global_summary(chs, exam=False):
-    all_text = []
-    for c in chs:
-        for it in c.get("items", []):
-            t = str(it.get("text", ""))
-            if t:
-                all_text.append(t)
-    text = "。".join(all_text)
+    # 全部章节正文直接在 join 里拼成一个字符串，不再先攒一个中间列表
+    text = "。".join(t for c in chs for it in c.get("items", []) if (t := str(it.get("text", ""))))
     rec = {"one_paragraph": simple_summarize(text, 360), "one_line": simple_summarize(text, 100)}
     if exam:
         pts, pits, tips = exam_extract(text)
@@ -134,9 +184,10 @@ def global_summary(chs, exam=False):
 
 def write_jsonl(recs, path):
     Path(path).parent.mkdir(parents=True, exist_ok=True)
-    with open(path, "w", encoding="utf-8") as f:
-        for r in recs:
-            f.write(json.dumps(r, ensure_ascii=False) + "\n")
+    # 每 WRITE_CHUNK 条编码后拼成一块写出，既少了逐条 write，峰值内存也有上限
+    with open(path, "wb") as f:
+        for i in range(0, len(recs), WRITE_CHUNK):
+            f.write(b"".join(map(_dumps_line, recs[i:i + WRITE_CHUNK])))
 
 def write_text(recs, path):
     """将JSON数据转换为易读的文本格式"""
@@ -184,33 +235,26 @@ def write_text(recs, path):
             f.write("📈 微段摘要\n")
             f.write("=" * 60 + "\n\n")
             
+            # 各条先拼进列表，最后一次写出
+            parts = []
             for i, rec in enumerate(recs, 1):
-                start_ms = rec.get('start_ms', 0)
-                end_ms = rec.get('end_ms', 0)
-                start_min = start_ms // 60000
-                start_sec = (start_ms % 60000) // 1000
-                end_min = end_ms // 60000
-                end_sec = (end_ms % 60000) // 1000
+                start_min, start_sec = divmod(rec.get('start_ms', 0) // 1000, 60)
+                end_min, end_sec = divmod(rec.get('end_ms', 0) // 1000, 60)
                 
-                f.write(f"【时间段 {i:02d}】 {start_min:02d}:{start_sec:02d} - {end_min:02d}:{end_sec:02d}\n")
-                f.write(f"📝 摘要：{rec.get('summary', '无')}\n")
+                parts.append(f"【时间段 {i:02d}】 {start_min:02d}:{start_sec:02d} - {end_min:02d}:{end_sec:02d}\n")
+                parts.append(f"📝 摘要：{rec.get('summary', '无')}\n")
                 
                 if rec.get('exam_points'):
-                    f.write("🎯 考试要点：")
-                    f.write("、".join(rec['exam_points']))
-                    f.write("\n")
+                    parts.append("🎯 考试要点：" + "、".join(rec['exam_points']) + "\n")
                 
                 if rec.get('pitfalls'):
-                    f.write("⚠️ 易错点：")
-                    f.write("、".join(rec['pitfalls']))
-                    f.write("\n")
+                    parts.append("⚠️ 易错点：" + "、".join(rec['pitfalls']) + "\n")
                 
                 if rec.get('tips'):
-                    f.write("💡 学习建议：")
-                    f.write("、".join(rec['tips']))
-                    f.write("\n")
+                    parts.append("💡 学习建议：" + "、".join(rec['tips']) + "\n")
                 
-                f.write("-" * 40 + "\n\n")
+                parts.append("-" * 40 + "\n\n")
+            f.write("".join(parts))
         
         # 检查是否为章节摘要（包含chapter_id字段）
         elif "chapter_id" in recs[0]:
@@ -246,16 +290,25 @@ def main():
     chap = chapter_summaries(chs)
     glob = global_summary(chs, exam=args.exam)
     
-    # 始终生成JSON格式
-    write_jsonl(micro, str(Path(args.outdir)/"micro_summary.jsonl"))
-    write_jsonl(chap, str(Path(args.outdir)/"chapter_summary.jsonl"))
-    write_jsonl([glob], str(Path(args.outdir)/"global_summary.jsonl"))
-    
-    # 可选生成文本格式
+    # 各输出文件互不依赖，放进线程池并发写，最后统一等待（并抛出其中的异常）
+    with ThreadPoolExecutor(max_workers=6) as ex:
+        # 始终生成JSON格式
+        futs = [
+            ex.submit(write_jsonl, micro, str(Path(args.outdir)/"micro_summary.jsonl")),
+            ex.submit(write_jsonl, chap, str(Path(args.outdir)/"chapter_summary.jsonl")),
+            ex.submit(write_jsonl, [glob], str(Path(args.outdir)/"global_summary.jsonl")),
+        ]
+        
+        # 可选生成文本格式
+        if args.text_format:
+            futs += [
+                ex.submit(write_text, micro, str(Path(args.outdir)/"micro_summary.txt")),
+                ex.submit(write_text, chap, str(Path(args.outdir)/"chapter_summary.txt")),
+                ex.submit(write_text, [glob], str(Path(args.outdir)/"global_summary.txt")),
+            ]
+        for fut in futs:
+            fut.result()
     if args.text_format:
-        write_text(micro, str(Path(args.outdir)/"micro_summary.txt"))
-        write_text(chap, str(Path(args.outdir)/"chapter_summary.txt"))
-        write_text([glob], str(Path(args.outdir)/"global_summary.txt"))
         print("✅ 文本格式文件已生成")
 
 if __name__ == "__main__":
@@ -1,5 +1,14 @@
 #!/usr/bin/env python3
+import asyncio
+import hashlib
+import io
+import os
+import threading
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from pathlib import Path
 import json
 from fastapi import FastAPI, UploadFile, File, Form
@@ -7,30 +16,109 @@ from fastapi.responses import FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 import shutil
 import client as pipeline
-from threading import Thread
 import time
 import llm_analyzer as la
 
-app = FastAPI()
-app.mount("/static", StaticFiles(directory="static"), name="static")
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+_loads = orjson.loads if orjson is not None else json.loads
+
+# 任务状态由后台线程写、请求处理函数读，统一经 _STATE_LOCK 存取；
+# 两个表各最多保留 JOB_STORE_MAX 个 uid，超出时淘汰最早写入的，服务长期运行内存不再无限增长
 PROGRESS = {}
 RESULTS = {}
+JOB_STORE_MAX = 4096
+_STATE_LOCK = threading.Lock()
+# 后台任务进固定大小的线程池排队（SAGE_MAX_JOBS，默认 2），并发上传不再各开一个线程争抢 GIL 与显存
+_JOB_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.environ.get("SAGE_MAX_JOBS", "2")), thread_name_prefix="job")
+
+@asynccontextmanager
+async def _lifespan(app):
+    yield
+    # 线程池的工作线程不是守护线程，解释器退出时会等队列里所有任务跑完；停服时直接丢弃排队中的任务
+    _JOB_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
+app = FastAPI(lifespan=_lifespan)
+app.mount("/static", StaticFiles(directory="static"), name="static")
+
+def _store_put(store, key, value):
+    with _STATE_LOCK:
+        store.pop(key, None)
+        store[key] = value
+        while len(store) > JOB_STORE_MAX:
+            del store[next(iter(store))]
+
+def _store_get(store, key, default=None):
+    with _STATE_LOCK:
+        return store.get(key, default)
 
 def read_jsonl(path):
+    # 按 (路径, mtime, 大小) 缓存解析结果：结果文件生成后不再变，轮询 /final、/notes 时直接命中内存
+    try:
+        st = Path(path).stat()
+    except OSError:
+        return []
+    return list(_read_jsonl_cached(str(path), st.st_mtime_ns, st.st_size))
+
+@lru_cache(maxsize=256)
+def _read_jsonl_cached(path, mtime_ns, size):
     out = []
-    p = Path(path)
-    if not p.exists():
-        return out
-    with open(p, "r", encoding="utf-8") as f:
+    with open(path, "rb") as f:
         for line in f:
             line = line.strip()
             if not line:
                 continue
             try:
-                out.append(json.loads(line))
+                out.append(_loads(line))
             except Exception:
                 continue
-    return out
+    return tuple(out)
+
+UPLOAD_COPY_SIZE = 1 << 20
+
+def _save_upload(upload, dst):
+    """上传落盘：源是真实文件时用 sendfile 在内核里直接拷贝，否则按 1 MiB 块复制（默认块只有 16 KiB）"""
+    src = upload.file
+    start = src.tell()
+    # 还在内存里的小上传直接复制：对 SpooledTemporaryFile 调 fileno() 会先把它整个转存成临时文件，反而多写一遍；
+    # 不依赖 _rolled 这类解释器内部标志，只看底层对象是不是 BytesIO（取不到就当作真实文件，失败时下面会退回复制）
+    in_memory = isinstance(src, io.BytesIO) or isinstance(getattr(src, "_file", None), io.BytesIO)
+    with open(dst, "wb") as f:
+        if in_memory:
+            shutil.copyfileobj(src, f, length=UPLOAD_COPY_SIZE)
+            return
+        try:
+            src.flush()
+            src_fd = src.fileno()
+            size = os.fstat(src_fd).st_size
+            offset = start
+            while offset < size:
+                sent = os.sendfile(f.fileno(), src_fd, offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+            return
+        except (AttributeError, OSError, ValueError):
+            # 上传对象没有 fileno，或平台不支持 sendfile：从头改用大块复制
+            src.seek(start)
+            f.seek(0)
+            f.truncate()
+        shutil.copyfileobj(src, f, length=UPLOAD_COPY_SIZE)
+
+async def _save_upload_async(upload, dst):
+    """
+    异步按 1 MiB 分块读上传、在线程里写盘：大文件落盘期间不占用请求线程池的槽位，
+    其他请求照常处理（/process 整体是阻塞的流水线，仍用同步的 _save_upload）
+    """
+    with open(dst, "wb") as f:
+        while True:
+            chunk = await upload.read(UPLOAD_COPY_SIZE)
+            if not chunk:
+                break
+            await asyncio.to_thread(f.write, chunk)
 
 @app.get("/")
 def index():
@@ -40,8 +128,35 @@ def index():
 def process_ui():
     return FileResponse(Path("static")/"process.html")
 
+def _rank_analysis(recs):
+    """展开各段落的 items，重点（类别=重点 或 type=key_content）排前，其余保持原顺序在后"""
+    key_first = []
+    non_after = []
+    ka, na = key_first.append, non_after.append
+    for r in recs:
+        for it in r.get("items", []):
+            # JSON 里这两个字段只会是字符串，直接比较，不再逐条 str()
+            if it.get("类别") == "重点" or it.get("type") == "key_content":
+                ka(it)
+            else:
+                na(it)
+    return key_first + non_after
+
+def _rank_focus(path):
+    """读取 focus_analysis.jsonl 并排序；与 read_jsonl 一样按 (路径, mtime, 大小) 缓存，文件不存在时为空列表"""
+    try:
+        st = Path(path).stat()
+    except OSError:
+        return []
+    return list(_rank_focus_cached(str(path), st.st_mtime_ns, st.st_size))
+
+@lru_cache(maxsize=256)
+def _rank_focus_cached(path, mtime_ns, size):
+    return tuple(_rank_analysis(_read_jsonl_cached(path, mtime_ns, size)))
+
 def _set_progress(uid, stage, steps, error=None):
-    PROGRESS[uid] = {"uid": uid, "stage": stage, "steps": steps, "error": error}
+    # steps 由任务线程继续修改，存一份拷贝，读者不会看到改到一半的状态
+    _store_put(PROGRESS, uid, {"uid": uid, "stage": stage, "steps": dict(steps), "error": error})
 
 def _run_job(uid, save_path, params):
     try:
@@ -49,12 +164,11 @@ def _run_job(uid, save_path, params):
         outdir = base/"out"
         cleanout = base/"cleanout"
         finalout = base/"finalout"
-        tmp_audio_dir = base/"tmp_audio"
         pipeline.ensure_dirs(str(outdir), str(cleanout), str(finalout))
         steps = {"upload": "done", "asr": "pending", "clean": "pending", "chapters": "pending", "summaries": "pending", "llm": "pending", "done": "pending"}
         _set_progress(uid, "asr", steps)
         train_jsonl = str(outdir/"train.jsonl")
-        pipeline.run_asr(str(save_path), train_jsonl, str(tmp_audio_dir), params["engine"], params["model_size"], params["device"], params["compute_type"], params["language"], params["segment_time"])
+        pipeline.run_asr(str(save_path), train_jsonl, str(base/"tmp_audio"), params["engine"], params["model_size"], params["device"], params["compute_type"], params["language"], params["segment_time"])
         steps["asr"] = "done"
         _set_progress(uid, "clean", steps)
         clean_paragraphs = str(cleanout/"clean_paragraphs.jsonl")
@@ -65,7 +179,7 @@ def _run_job(uid, save_path, params):
         pipeline.run_chapters(clean_paragraphs, chapters_jsonl, params["min_gap_chapter_ms"], params["min_len_chapter_chars"], params["chapter_threshold"], text_format=True)
         steps["chapters"] = "done"
         _set_progress(uid, "summaries", steps)
-        pipeline.run_summaries(train_jsonl, chapters_jsonl, str(finalout), params["window_sec"], bool(params["exam"]), text_format=True)
+        summaries = pipeline.run_summaries(train_jsonl, chapters_jsonl, str(finalout), params["window_sec"], bool(params["exam"]), text_format=True)
         steps["summaries"] = "done"
         if params["llm_enable"] and params["llm_api_key"]:
             _set_progress(uid, "llm", steps)
@@ -76,31 +190,13 @@ def _run_job(uid, save_path, params):
             except Exception:
                 steps["llm"] = "failed"
         _set_progress(uid, "done", steps)
-        micro = read_jsonl(finalout/"micro_summary.jsonl")
-        chapter = read_jsonl(finalout/"chapter_summary.jsonl")
-        global_ = read_jsonl(finalout/"global_summary.jsonl")
-        analysis = []
-        ap = finalout/"focus_analysis.jsonl"
-        if ap.exists():
-            recs = read_jsonl(ap)
-            flat = []
-            for r in recs:
-                items = r.get("items", [])
-                for it in items:
-                    flat.append(it)
-            key_first = []
-            non_after = []
-            for it in flat:
-                cat = str(it.get("类别", ""))
-                typ = str(it.get("type", ""))
-                if cat == "重点" or typ == "key_content":
-                    key_first.append(it)
-                else:
-                    non_after.append(it)
-            analysis = key_first + non_after
-        RESULTS[uid] = {"uid": uid, "micro_summary": micro, "chapter_summary": chapter, "global_summary": global_, "focus_analysis": analysis}
+        micro = summaries["micro_summary"]
+        chapter = summaries["chapter_summary"]
+        global_ = summaries["global_summary"]
+        analysis = _rank_focus(finalout/"focus_analysis.jsonl")
+        _store_put(RESULTS, uid, {"uid": uid, "micro_summary": micro, "chapter_summary": chapter, "global_summary": global_, "focus_analysis": analysis})
     except Exception:
-        _set_progress(uid, "error", PROGRESS.get(uid, {}).get("steps", {}), error="pipeline_failed")
+        _set_progress(uid, "error", _store_get(PROGRESS, uid, {}).get("steps", {}), error="pipeline_failed")
 
 @app.post("/analyze_clean")
 def analyze_clean(
@@ -120,6 +216,10 @@ def analyze_clean(
         return JSONResponse(status_code=500, content={"error": "llm_failed"})
     return read_jsonl(outp)
 
+ANALYZE_CACHE_MAX = 256
+_ANALYZE_CACHE = OrderedDict()
+_ANALYZE_LOCK = threading.Lock()
+
 @app.post("/analyze_text")
 def analyze_text(
     text: str = Form(...),
@@ -128,8 +228,23 @@ def analyze_text(
     llm_base_url: str = Form("https://api.deepseek.com/v1"),
     dry_run: int = Form(0)
 ):
+    # 同一段文本重复提交（用户重复点“分析”）直接命中内存；LLM 失败退回本地规则的结果不缓存，下次仍会重试
+    # 键里带上 API key 的摘要：不同调用方（或无效 key）不会拿到别人付费调用的结果，也不会绕过鉴权失败
+    key = (hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest(),
+           hashlib.blake2b(llm_api_key.encode("utf-8"), digest_size=16).hexdigest(),
+           llm_base_url, llm_model, bool(dry_run))
+    with _ANALYZE_LOCK:
+        arr = _ANALYZE_CACHE.get(key)
+        if arr is not None:
+            _ANALYZE_CACHE.move_to_end(key)
+            return arr
     sents = la._split_sentences(text)
     arr = la.analyze_sentences_custom(sents, api_key=llm_api_key, base_url=llm_base_url, model=llm_model, dry_run=bool(dry_run))
+    if dry_run or arr != [{"text": s, "type": la._heuristic_type(s)} for s in sents]:
+        with _ANALYZE_LOCK:
+            _ANALYZE_CACHE[key] = arr
+            while len(_ANALYZE_CACHE) > ANALYZE_CACHE_MAX:
+                _ANALYZE_CACHE.popitem(last=False)
     return arr
 
 @app.post("/process")
@@ -138,7 +253,7 @@ def process_video(
     engine: str = Form("auto"),
     model_size: str = Form("medium"),
     device: str = Form("cuda"),
-    compute_type: str = Form("float16"),
+    compute_type: str = Form("int8_float16"),
     language: str = Form("zh"),
     segment_time: int = Form(120),
     min_chars: int = Form(200),
@@ -158,24 +273,22 @@ def process_video(
     vid_dir.mkdir(parents=True, exist_ok=True)
     uid = str(uuid.uuid4())
     save_path = vid_dir / f"{uid}_{video.filename}"
-    with open(save_path, "wb") as f:
-        shutil.copyfileobj(video.file, f)
+    _save_upload(video, save_path)
     base = Path("web_out")/uid
     outdir = base/"out"
     cleanout = base/"cleanout"
     finalout = base/"finalout"
-    tmp_audio_dir = base/"tmp_audio"
     pipeline.ensure_dirs(str(outdir), str(cleanout), str(finalout))
     train_jsonl = str(outdir/"train.jsonl")
     try:
-        pipeline.run_asr(str(save_path), train_jsonl, str(tmp_audio_dir), engine, model_size, device, compute_type, language, segment_time)
+        pipeline.run_asr(str(save_path), train_jsonl, str(base/"tmp_audio"), engine, model_size, device, compute_type, language, segment_time)
     except Exception:
         return JSONResponse(status_code=500, content={"error": "asr_failed"})
     clean_paragraphs = str(cleanout/"clean_paragraphs.jsonl")
     pipeline.run_clean(train_jsonl, clean_paragraphs, min_chars, max_gap_ms, style)
     chapters_jsonl = str(outdir/"chapters.jsonl")
     pipeline.run_chapters(clean_paragraphs, chapters_jsonl, min_gap_chapter_ms, min_len_chapter_chars, chapter_threshold, text_format=True)
-    pipeline.run_summaries(train_jsonl, chapters_jsonl, str(finalout), window_sec, bool(exam), text_format=True)
+    summaries = pipeline.run_summaries(train_jsonl, chapters_jsonl, str(finalout), window_sec, bool(exam), text_format=True)
     analysis = []
     analysis_path = finalout/"focus_analysis.jsonl"
     if llm_enable and llm_api_key:
@@ -183,34 +296,19 @@ def process_video(
             la.analyze_file_custom(clean_paragraphs, str(analysis_path), llm_api_key, llm_base_url, llm_model, dry_run=False)
         except Exception:
             pipeline.run_llm_analysis(clean_paragraphs, str(analysis_path), llm_api_key, llm_base_url, llm_model, text_format=True, dry_run=False)
-        recs = read_jsonl(analysis_path)
-        flat = []
-        for r in recs:
-            items = r.get("items", [])
-            for it in items:
-                flat.append(it)
-        key_first = []
-        non_after = []
-        for it in flat:
-            cat = str(it.get("类别", ""))
-            typ = str(it.get("type", ""))
-            if cat == "重点" or typ == "key_content":
-                key_first.append(it)
-            else:
-                non_after.append(it)
-        analysis = key_first + non_after
-    micro = read_jsonl(finalout/"micro_summary.jsonl")
-    chapter = read_jsonl(finalout/"chapter_summary.jsonl")
-    global_ = read_jsonl(finalout/"global_summary.jsonl")
+        analysis = _rank_focus(analysis_path)
+    micro = summaries["micro_summary"]
+    chapter = summaries["chapter_summary"]
+    global_ = summaries["global_summary"]
     return {"uid": uid, "micro_summary": micro, "chapter_summary": chapter, "global_summary": global_, "focus_analysis": analysis}
 
 @app.post("/start_process")
-def start_process(
+async def start_process(
     video: UploadFile = File(...),
     engine: str = Form("auto"),
     model_size: str = Form("medium"),
     device: str = Form("cuda"),
-    compute_type: str = Form("float16"),
+    compute_type: str = Form("int8_float16"),
     language: str = Form("zh"),
     segment_time: int = Form(120),
     min_chars: int = Form(200),
@@ -230,8 +328,7 @@ def start_process(
     vid_dir.mkdir(parents=True, exist_ok=True)
     uid = str(uuid.uuid4())
     save_path = vid_dir / f"{uid}_{video.filename}"
-    with open(save_path, "wb") as f:
-        shutil.copyfileobj(video.file, f)
+    await _save_upload_async(video, save_path)
     params = {
         "engine": engine, "model_size": model_size, "device": device, "compute_type": compute_type,
         "language": language, "segment_time": segment_time, "min_chars": min_chars, "max_gap_ms": max_gap_ms,
@@ -240,20 +337,19 @@ def start_process(
         "llm_enable": llm_enable, "llm_api_key": llm_api_key, "llm_model": llm_model, "llm_base_url": llm_base_url
     }
     _set_progress(uid, "queued", {"upload": "done", "asr": "pending", "clean": "pending", "chapters": "pending", "summaries": "pending", "llm": "pending", "done": "pending"})
-    t = Thread(target=_run_job, args=(uid, save_path, params))
-    t.daemon = True
-    t.start()
+    _JOB_EXECUTOR.submit(_run_job, uid, save_path, params)
     return {"uid": uid}
 
 @app.get("/progress")
 def progress(uid: str):
-    return PROGRESS.get(uid, {"uid": uid, "stage": "unknown", "steps": {}, "error": "not_found"})
+    return _store_get(PROGRESS, uid, {"uid": uid, "stage": "unknown", "steps": {}, "error": "not_found"})
 
 @app.get("/final")
 def final(uid: str):
-    if uid in RESULTS:
-        return RESULTS[uid]
-    p = PROGRESS.get(uid)
+    res = _store_get(RESULTS, uid)
+    if res is not None:
+        return res
+    p = _store_get(PROGRESS, uid)
     if not p:
         return JSONResponse(status_code=404, content={"error": "not_found"})
     if p.get("stage") == "error":
@@ -269,10 +365,14 @@ def notes(
     style: str = Form("college"),
     dry_run: int = Form(0)
 ):
-    base = Path("web_out")/uid/"finalout"
-    ch = read_jsonl(base/"chapter_summary.jsonl")
-    gl = read_jsonl(base/"global_summary.jsonl")
-    mi = read_jsonl(base/"micro_summary.jsonl")
+    res = _store_get(RESULTS, uid)
+    if res is not None:
+        ch, gl, mi = res["chapter_summary"], res["global_summary"], res["micro_summary"]
+    else:
+        base = Path("web_out")/uid/"finalout"
+        ch = read_jsonl(base/"chapter_summary.jsonl")
+        gl = read_jsonl(base/"global_summary.jsonl")
+        mi = read_jsonl(base/"micro_summary.jsonl")
     def collapse():
         parts = []
         title = "《学习笔记》"
@@ -321,7 +421,8 @@ def notes(
         "chapters": ch,
         "micro": mi
     }
-    user = json.dumps(src, ensure_ascii=False)
+    # 摘要全是中文，orjson 的 C 编码器比 json.dumps(ensure_ascii=False) 快一个数量级
+    user = orjson.dumps(src).decode("utf-8") if orjson is not None else json.dumps(src, ensure_ascii=False)
     try:
         url = llm_base_url.rstrip("/") + "/chat/completions"
         headers = {"Authorization": f"Bearer {llm_api_key}", "Content-Type": "application/json"}